@@ -0,0 +1,179 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.#
+"""Chef resource block rendering shared by the Chef processors.
+
+This is not a processor. The resource processors import it from their own
+directory and describe their block with a ResourceSchema.
+"""
+
+from __future__ import absolute_import
+
+from autopkglib import ProcessorError
+
+__all__ = ["ResourceSchema"]
+
+
+def ruby_string(value):
+    """Return value as a single-quoted Ruby string literal."""
+    return "'%s'" % value.replace("\\", "\\\\").replace("'", "\\'")
+
+
+class ResourceSchema(object):
+    """Describe how a processor's inputs become one Chef resource block.
+
+    block_name is the Chef resource and prefix the prefix of the inputs
+    that hold its attributes, which is stripped to get the attribute name.
+    list_end ends a block rendered for several resource names, and
+    final_newline adds a blank line after every block. With tabs, the
+    older tab-indented layout is used, without the indentation and
+    resource_array options.
+
+    The attribute order only depends on the processor class, so it is
+    worked out on the first render and reused after that.
+    """
+
+    def __init__(
+        self, block_name, prefix="", list_end="end\n\n", final_newline=True, tabs=False
+    ):
+        self.block_name = block_name
+        self.prefix = prefix
+        self.list_end = list_end
+        self.final_newline = final_newline
+        self.tabs = tabs
+        self.indent = "\t" if tabs else "  "
+        self.guards = (
+            ("%snot_if" % prefix, "not_if"),
+            ("%sonly_if" % prefix, "only_if"),
+        )
+        if tabs:
+            self.guards = tuple((key, "\t" + text) for key, text in self.guards)
+        self.attributes = None
+        self.name_variable = False
+
+    def prepare(self, input_variables):
+        """Work out the attribute keys, in order, and their names."""
+        special = set(key for key, _ in self.guards)
+        special.update(
+            [
+                "%sextra_indentation" % self.prefix,
+                "%sindentation_end" % self.prefix,
+                "%sresource_array" % self.prefix,
+                "resource_name",
+                "resource_name_prefix",
+                "resource_name_variable",
+            ]
+        )
+        attributes = []
+        for key in sorted(input_variables):
+            if key in special:
+                continue
+            if self.tabs:
+                attributes.append((key, "\t" + key))
+            else:
+                attributes.append((key, key.replace(self.prefix, "")))
+        self.name_variable = "resource_name_variable" in input_variables
+        self.attributes = attributes
+
+    def resource_names(self, env):
+        """Return the resource names as a list.
+
+        Lists are used as-is and strings are split on commas. With
+        resource_name_variable, the names come from the variable it names.
+        Those are plain paths rather than Ruby, so each one gets
+        resource_name_prefix and is quoted as a Ruby string.
+        """
+        quote = self.name_variable and env.get("resource_name_variable")
+        if quote:
+            resource_names = env.get(env["resource_name_variable"])
+        else:
+            resource_names = env.get("resource_name")
+        if not resource_names:
+            raise ProcessorError("No resource_name provided!")
+        if not isinstance(resource_names, list):
+            resource_names = resource_names.split(",")
+        if quote:
+            prefix = env.get("resource_name_prefix") or ""
+            resource_names = [ruby_string(prefix + name) for name in resource_names]
+        return resource_names
+
+    def render(self, processor):
+        """Render processor's chef_block and clear the inputs it used."""
+        if self.attributes is None:
+            self.prepare(processor.input_variables)
+        env = processor.env
+        if self.tabs:
+            block, extra_formatting, end_text = self.tab_head(env)
+        else:
+            block, extra_formatting, end_text = self.head(processor)
+        indent = extra_formatting + self.indent
+        # not_if and only_if guards go first
+        for key, text in self.guards:
+            if env.get(key):
+                block.append("%s%s %s\n" % (indent, text, env[key]))
+            env[key] = ""
+        for key, text in self.attributes:
+            if env.get(key, ""):
+                block.append("%s%s %s\n" % (indent, text, env[key]))
+            # Clear out the key so it doesn't poison future runs
+            env[key] = ""
+        block.append(end_text)
+        if self.final_newline:
+            block.append("\n")
+        env["chef_block"] = "".join(block)
+        processor.output("Chef block:\n%s" % env["chef_block"])
+        if not self.tabs:
+            env["%sextra_indentation" % self.prefix] = ""
+            env["%sindentation_end" % self.prefix] = ""
+        if self.name_variable:
+            env["resource_name_variable"] = ""
+            env["resource_name_prefix"] = ""
+
+    def head(self, processor):
+        """Return the opening lines, attribute indentation and end text."""
+        env = processor.env
+        extra_formatting = ""
+        indent_block = ""
+        end_text = "end\n"
+        # Should this block be indented?
+        if env.get("%sextra_indentation" % self.prefix):
+            processor.output("Adding indentation.")
+            indent_block = "  "
+            end_text = "  " + end_text
+            extra_formatting = "  "
+        # Should this end an indented block?
+        if env.get("%sindentation_end" % self.prefix):
+            end_text = end_text + "end\n"
+        resource_names = self.resource_names(env)
+        # Check to see if only one item was passed
+        if len(resource_names) == 1:
+            if env.get("%sresource_array" % self.prefix):
+                # it's a node variable representating an array
+                opening = ".each do |item|\n"
+            else:
+                opening = " do\n"
+            block = [indent_block, self.block_name, " ", resource_names[0], opening]
+            return block, extra_formatting, end_text
+        block = [
+            "[\n",
+            ",\n".join("  %s" % name for name in resource_names),
+            "\n].each do |item|\n",
+            "%s item do\n" % self.block_name,
+        ]
+        # Insert an extra indent before everything
+        return block, "  ", indent_block + self.list_end
+
+    def tab_head(self, env):
+        """Return the opening lines, attribute indentation and end text."""
+        resource_name = env.get("resource_name")
+        if isinstance(resource_name, str):
+            return ["%s %s do\n" % (self.block_name, resource_name)], "", "end\n"
+        # Not a string, assume it's an array of strings
+        block = ["[\n"]
+        block.extend("\t%s,\n" % name for name in resource_name or [])
+        block.append("].each do |item|\n\t%s item do\n" % self.block_name)
+        return block, "\t", self.list_end
@@ -9,8 +9,17 @@
 
 from __future__ import absolute_import
 
+import os
+import sys
+
 from autopkglib import Processor
 
+# AutoPkg loads processors by file path, so make the shared helper next to
+# this file importable.
+if os.path.dirname(__file__) not in sys.path:
+    sys.path.insert(0, os.path.dirname(__file__))
+from ChefBlock import ResourceSchema  # noqa: E402
+
 __all__ = ["ChefDirectory"]
 
 
@@ -21,13 +30,33 @@ class ChefDirectory(Processor):
     )
     input_variables = {
         "resource_name": {
-            "required": True,
+            "required": False,
             "description": (
                 "Name for the resource. This can be a single "
                 "string or an array of strings. If an array is "
                 "provided, the first item in the array will be the "
                 "resource name and the rest will be turned "
-                "into an array."
+                "into an array. A comma-separated string is split "
+                "into an array. Required unless "
+                "resource_name_variable is set."
+            ),
+        },
+        "resource_name_variable": {
+            "required": False,
+            "description": (
+                "Name of an environment variable holding a list of "
+                "resource names, such as found_filenames_list or "
+                "found_directories_list from SubDirectoryList. Used "
+                "instead of resource_name, without splitting on commas. "
+                "Each name is written as a quoted Ruby string."
+            ),
+        },
+        "resource_name_prefix": {
+            "required": False,
+            "description": (
+                "With resource_name_variable, a path prepended to each "
+                "name, such as the directory SubDirectoryList listed. It "
+                "is prepended as-is, so end it with a slash."
             ),
         },
         "directory_resource_array": {
@@ -124,108 +153,12 @@ class ChefDirectory(Processor):
     }
     output_variables = {"chef_block": {"description": "Chef block."}}
 
+    schema = ResourceSchema("directory", "directory_")
+
     __doc__ = description
 
     def main(self):
-        # chef block variables
-        prefix = "directory_"
-        block_name = "directory"
-
-        # formatting variables
-        extra_formatting = ""
-        end_text = "end\n"
-        self.env["chef_block"] = ""
-        each_do_beginning = "[\n"
-        each_do_end = ".each do |item|\n"
-        self.env["chef_block"] = each_do_beginning
-        name = "item"
-        notif_text = "not_if"
-        onlyif_text = "only_if"
-        indent_block = ""
-
-        # Should this block be indented?
-        if self.env.get("%sextra_indentation" % prefix):
-            self.output("Adding indentation.")
-            indent_block = "  "
-            end_text = "  " + end_text
-            extra_formatting = "  "
-        # Should this end an indented block?
-        if self.env.get("%sindentation_end" % prefix):
-            end_text = end_text + "end\n"
-
-        # Check to see if only one item was passed
-        if len(self.env["resource_name"].split(",")) == 1:
-            if self.env.get("%sresource_array" % prefix):
-                # it's a node variable representating an array
-                self.env["chef_block"] = (
-                    indent_block
-                    + block_name
-                    + " "
-                    + self.env["resource_name"]
-                    + each_do_end
-                )
-            else:
-                self.env["chef_block"] = (
-                    indent_block
-                    + block_name
-                    + " "
-                    + self.env["resource_name"]
-                    + " do\n"
-                )
-        else:
-            for resource_name in self.env["resource_name"].split(","):
-                self.env["chef_block"] += "  %s,\n" % resource_name
-            self.env["chef_block"] += "]" + each_do_end
-            # Remove trailing comma
-            self.env["chef_block"] = self.env["chef_block"].replace(",\n]", "\n]")
-            self.env["chef_block"] += "%s %s do\n" % (block_name, name)
-            # Insert an extra tab before everything
-            extra_formatting = "  "
-            end_text = indent_block + "end\n\n"
-
-        input_list = sorted(self.input_variables.keys())
-        # Start the block
-        # Remove the indentation keys
-        input_list.remove("%sextra_indentation" % prefix)
-        input_list.remove("%sindentation_end" % prefix)
-        # Place not_if guards first
-        if self.env.get("%snot_if" % prefix):
-            self.env["chef_block"] += "%s  %s %s\n" % (
-                extra_formatting,
-                notif_text,
-                self.env["%snot_if" % prefix],
-            )
-            input_list.remove("%snot_if" % prefix)
-        # Place only_if guards next
-        if self.env.get("%sonly_if" % prefix):
-            self.env["chef_block"] += "%s  %s %s\n" % (
-                extra_formatting,
-                onlyif_text,
-                self.env["%sonly_if" % prefix],
-            )
-            input_list.remove("%sonly_if" % prefix)
-        # Remove the special keys
-        input_list.remove("%sresource_array" % prefix)
-        input_list.remove("resource_name")
-        # Loop through all remaining keys
-        for key in input_list:
-            if self.env.get(key, ""):
-                key_text = "%s" % key.replace("%s" % prefix, "")
-                self.env["chef_block"] += "%s  %s %s\n" % (
-                    extra_formatting,
-                    key_text,
-                    self.env[key],
-                )
-            # Clear out the key so it doesn't poison future runs
-            self.env[key] = ""
-        # end it
-        self.env["chef_block"] += end_text + "\n"
-        self.output("Chef block:\n%s" % self.env["chef_block"])
-        # Clean up the keys that weren't iterated through
-        self.env["%sextra_indentation" % prefix] = ""
-        self.env["%sindentation_end" % prefix] = ""
-        self.env["%snot_if" % prefix] = ""
-        self.env["%sonly_if" % prefix] = ""
+        self.schema.render(self)
 
 
 if __name__ == "__main__":
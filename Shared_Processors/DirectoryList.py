@@ -10,13 +10,48 @@
 
 from __future__ import absolute_import
 
+import fnmatch
+import functools
+import heapq
 import os
+import re
+import sys
 from glob import glob
 
 from autopkglib import Processor, ProcessorError
 
+# AutoPkg loads processors by file path, so make the shared helper next to
+# this file importable.
+if os.path.dirname(__file__) not in sys.path:
+    sys.path.insert(0, os.path.dirname(__file__))
+from PathFilter import PathFilter  # noqa: E402
+
 __all__ = ["DirectoryList"]
 
+VERSION_TOKEN_RE = re.compile(r"(\d+)")
+
+
+@functools.lru_cache(maxsize=65536)
+def version_key(name):
+    """Sort key that orders embedded numbers numerically.
+
+    "android-ndk-r9" sorts before "android-ndk-r21". Text runs sort as
+    strings and number runs as integers; the tags keep the two apart when
+    names differ in shape. Keys are cached, so sorting and picking the
+    newest match tokenize each name only once.
+    """
+    tokens = VERSION_TOKEN_RE.split(name)
+    return tuple(
+        (1, int(token), "") if index % 2 else (0, 0, token)
+        for index, token in enumerate(tokens)
+        if token
+    )
+
+
+def path_version_key(path):
+    """version_key of the last component of path."""
+    return version_key(os.path.basename(path))
+
 
 class DirectoryList(Processor):
     """Returns a list of items in a subdirectory as a string, separated by
@@ -27,22 +62,59 @@ class DirectoryList(Processor):
 
     input_variables = {
         "pattern": {
-            "description": "Shell glob pattern to match files by",
+            "description": (
+                "Shell glob pattern to match files by. For the regex and "
+                "fnmatch find methods, the last path component is the "
+                "pattern and the rest is the directory to list."
+            ),
             "required": True,
         },
         "find_method": {
             "description": (
-                "Type of pattern to match. Currently only "
-                'supported type is "glob" (also the default)'
+                'Type of pattern to match. Either "glob" (the default), '
+                '"regex" or "fnmatch". regex and fnmatch match names from a '
+                "single listing of the directory and must match the whole "
+                "name."
             ),
             "default": "glob",
             "required": False,
         },
+        "sort_order": {
+            "description": (
+                'Order of found_filenames. Either "lexical" (the default) or '
+                '"version", which compares embedded numbers numerically so '
+                "android-ndk-r9 comes before android-ndk-r21."
+            ),
+            "default": "lexical",
+            "required": False,
+        },
+        "newest_count": {
+            "description": (
+                "Only return this many of the newest matches, in natural "
+                "version order (so r21 is newer than r9). They are picked "
+                "with a heap rather than by sorting every match."
+            ),
+            "required": False,
+        },
         "remove_extension": {
             "description": ("Remove the extension at the end. Default to False."),
             "default": False,
             "required": False,
         },
+        "include_patterns": {
+            "description": (
+                "List of gitignore-style patterns. If set, only matches "
+                "whose name matches one of them are kept."
+            ),
+            "required": False,
+        },
+        "exclude_patterns": {
+            "description": (
+                "List of gitignore-style patterns of names to leave out. "
+                "A trailing slash only matches directories."
+            ),
+            "required": False,
+        },
         "suffix_string": {
             "description": (
                 "String to append to each found item name in dir. Defaults to ','"
@@ -51,29 +123,95 @@ class DirectoryList(Processor):
             "required": False,
         },
     }
-    output_variables = {"found_filenames": {"description": "Found filename"}}
+    output_variables = {
+        "found_filenames": {"description": "Found filename"},
+        "newest_match": {"description": "The newest match in natural version order."},
+    }
 
     description = __doc__
 
-    def globfind(self, pattern):
-        """Returns multiple files matching a glob."""
-        # pylint: disable=no-self-use
+    def path_filter(self):
+        """Returns a PathFilter for the include/exclude patterns, if any."""
+        include = self.env.get("include_patterns")
+        exclude = self.env.get("exclude_patterns")
+        if not include and not exclude:
+            return None
+        return PathFilter(include=include, exclude=exclude)
 
+    def globfind(self, pattern):
+        """Returns the paths of files matching a glob."""
         glob_matches = glob(pattern)
-
-        if len(glob_matches) < 1:
+        path_filter = self.path_filter()
+        if path_filter:
+            glob_matches = [
+                x
+                for x in glob_matches
+                if (
+                    path_filter.keep_dir(os.path.basename(x))
+                    if os.path.isdir(x)
+                    else path_filter.keep_file(os.path.basename(x))
+                )
+            ]
+        return glob_matches
+
+    def scandirfind(self, pattern, method):
+        """Returns the paths in a directory whose names match a regex or fnmatch."""
+        directory, name_pattern = os.path.split(pattern)
+        if method == "fnmatch":
+            name_pattern = fnmatch.translate(name_pattern)
+        try:
+            matcher = re.compile(name_pattern).fullmatch
+        except re.error as err:
+            raise ProcessorError("Invalid pattern %s: %s" % (name_pattern, err))
+        path_filter = self.path_filter()
+        matches = []
+        try:
+            with os.scandir(directory or ".") as entries:
+                for entry in entries:
+                    if not matcher(entry.name):
+                        continue
+                    if path_filter and not (
+                        path_filter.keep_dir(entry.name)
+                        if entry.is_dir()
+                        else path_filter.keep_file(entry.name)
+                    ):
+                        continue
+                    matches.append(os.path.join(directory, entry.name))
+        except OSError as err:
+            raise ProcessorError("Can't list %s: %s" % (directory, err))
+        return matches
+
+    def select(self, matches):
+        """Returns the names of the sorted matches, or of the newest_count newest.
+
+        Lexical order is that of the full paths, so a glob spanning several
+        directories is ordered by directory first. Version order and
+        newness only look at the names.
+        """
+        if len(matches) < 1:
             raise ProcessorError("No matching filename found")
-
-        glob_matches.sort()
-
-        # return glob_matches
-        new_glob = []
-        for glob_item in glob_matches:
-            new_string = os.path.basename(glob_item)
-            if self.env["remove_extension"]:
-                new_string = os.path.splitext(new_string)[0]
-            new_glob.append(new_string)
-        return new_glob
+        sort_order = self.env.get("sort_order") or "lexical"
+        if sort_order not in ("lexical", "version"):
+            raise ProcessorError("Unsupported sort_order: %s" % sort_order)
+        newest_count = int(self.env.get("newest_count") or 0)
+        if newest_count:
+            # nlargest keeps a heap of newest_count items instead of sorting
+            # every match; flip it back to ascending order.
+            matches = heapq.nlargest(newest_count, matches, key=path_version_key)
+            matches.reverse()
+            if sort_order == "lexical":
+                matches.sort()
+        elif sort_order == "version":
+            matches.sort(key=path_version_key)
+        else:
+            matches.sort()
+        matches = [os.path.basename(x) for x in matches]
+        newest_match = max(matches, key=version_key)
+        if self.env["remove_extension"]:
+            matches = [os.path.splitext(x)[0] for x in matches]
+            newest_match = os.path.splitext(newest_match)[0]
+        self.env["newest_match"] = newest_match
+        return matches
 
     def main(self):
         pattern = self.env.get("pattern")
@@ -82,11 +220,14 @@ class DirectoryList(Processor):
         format_string = "%s" % self.env["suffix_string"]
         search_string = "{0}"
         if method == "glob":
-            self.env["found_filenames"] = search_string.format(
-                format_string.join(self.globfind(pattern))
-            ).strip()
+            matches = self.globfind(pattern)
+        elif method in ("regex", "fnmatch"):
+            matches = self.scandirfind(pattern, method)
         else:
             raise ProcessorError("Unsupported find_method: %s" % method)
+        self.env["found_filenames"] = search_string.format(
+            format_string.join(self.select(matches))
+        ).strip()
         self.output("Found matches: %s" % self.env["found_filenames"])
 
 
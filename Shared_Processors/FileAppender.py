@@ -9,6 +9,11 @@
 
 from __future__ import absolute_import
 
+import errno
+import os
+import stat
+from collections import OrderedDict
+
 from autopkglib import Processor, ProcessorError
 
 __all__ = ["FileAppender"]
@@ -19,20 +24,135 @@ class FileAppender(Processor):
 
     description = __doc__
     input_variables = {
-        "file_path": {"required": True, "description": "Path to a file to append to."},
-        "file_content": {"required": True, "description": "Contents to add to a file."},
+        "file_path": {"required": False, "description": "Path to a file to append to."},
+        "file_content": {
+            "required": False,
+            "description": "Contents to add to a file.",
+        },
+        "file_appends": {
+            "required": False,
+            "description": (
+                "List of appends to make in one step. Each item is either a "
+                "dictionary with file_path and file_content keys, or a "
+                "[file_path, file_content] pair. Appends to the same file are "
+                "joined in order and written once, and each file is replaced "
+                "through a temporary file so it is never left half written. "
+                "file_path and file_content, if also set, are added last."
+            ),
+        },
+        "file_fsync": {
+            "required": False,
+            "default": False,
+            "description": (
+                "With file_appends, flush each file to disk before it "
+                "replaces the original. Defaults to False."
+            ),
+        },
     }
     output_variables = {}
 
-    def main(self):
+    def append_pairs(self):
+        """Return file_appends (plus file_path) grouped per file, in order.
+
+        Files are keyed by their real path, so different spellings of one
+        file, or a symlink and its target, share a group and the appends
+        go to the file a symlink points at.
+        """
+        appends = list(self.env.get("file_appends") or [])
+        if self.env.get("file_path"):
+            appends.append([self.env["file_path"], self.env.get("file_content", "")])
+        grouped = OrderedDict()
+        for item in appends:
+            if isinstance(item, dict):
+                item = [item.get("file_path"), item.get("file_content", "")]
+            if len(item) != 2 or not item[0]:
+                raise ProcessorError("Invalid file_appends item: %s" % item)
+            path = os.path.realpath(item[0])
+            grouped.setdefault(path, []).append(item[1] or "")
+        return grouped
+
+    def stage_file(self, path, contents):
+        """Write path's current contents plus contents to a temporary file.
+
+        path is a real path, so the temporary file sits next to the file
+        itself rather than a symlink to it. Returns the temporary path. The
+        original file's mode, and its owner when running as root, are kept; a new
+        file gets the default mode, as if it had been opened for appending.
+        """
+        tmp_path = os.path.join(
+            os.path.dirname(path), ".%s.%d.tmp" % (os.path.basename(path), os.getpid())
+        )
+        try:
+            info = os.stat(path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            info = None
+        if info is None:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+            existing = b""
+        else:
+            mode = stat.S_IMODE(info.st_mode)
+            with open(path, "rb") as fileref:
+                existing = fileref.read()
         try:
-            with open(self.env["file_path"], "a") as fileref:
-                fileref.write(self.env["file_content"])
-            self.output("Appened to file at %s" % self.env["file_path"])
+            with open(tmp_path, "wb") as fileref:
+                fileref.write(existing + "".join(contents).encode("utf-8"))
+                if self.env.get("file_fsync"):
+                    fileref.flush()
+                    os.fsync(fileref.fileno())
+            if info is not None and os.geteuid() == 0:
+                os.chown(tmp_path, info.st_uid, info.st_gid)
+            os.chmod(tmp_path, mode)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return tmp_path
+
+    def batch_append(self):
+        """Append to every file in file_appends with one write per file.
+
+        All files are staged before any is renamed into place, so a failure
+        while writing leaves every file untouched.
+        """
+        staged = []
+        try:
+            for path, contents in self.append_pairs().items():
+                staged.append((self.stage_file(path, contents), path))
+            for tmp_path, path in staged:
+                os.rename(tmp_path, path)
+                self.output("Appended to file at %s" % path)
         except BaseException as err:
-            raise ProcessorError(
-                "Can't append to file at %s: %s" % (self.env["file_path"], err)
-            )
+            for tmp_path, _ in staged:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+            raise ProcessorError("Can't append to files: %s" % err)
+        if self.env.get("file_fsync"):
+            for directory in set(os.path.dirname(path) for _, path in staged):
+                dir_fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+
+    def main(self):
+        if self.env.get("file_appends"):
+            self.batch_append()
+            self.env["file_appends"] = []
+        elif not self.env.get("file_path"):
+            raise ProcessorError("Either file_path or file_appends is required!")
+        else:
+            try:
+                with open(self.env["file_path"], "a") as fileref:
+                    fileref.write(self.env.get("file_content", ""))
+                self.output("Appened to file at %s" % self.env["file_path"])
+            except BaseException as err:
+                raise ProcessorError(
+                    "Can't append to file at %s: %s" % (self.env["file_path"], err)
+                )
         # clean the variable up afterwards to not poison future runs
         self.env["file_content"] = ""
         self.env["file_path"] = ""
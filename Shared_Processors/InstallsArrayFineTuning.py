@@ -10,10 +10,59 @@
 
 from __future__ import absolute_import
 
+import fnmatch
+import re
+
 from autopkglib import Processor, ProcessorError
 
 __all__ = ["InstallsArrayFineTuning"]
 
+MATCH_TYPES = ("exact", "prefix", "glob")
+ACTIONS = ("set_type", "drop", "rewrite_prefix", "set_key", "strip_key")
+# Everything in a glob pattern before the first of these is a literal prefix.
+GLOB_SPECIAL = re.compile(r"[*?\[]")
+
+
+class RuleIndex(object):
+    """Find the rules of one pipeline stage that match a path.
+
+    Exact paths are a dict lookup. Prefix and glob rules are indexed by the
+    length and text of their literal prefix, so a path is only checked
+    against rules whose prefix it actually starts with: one slice and dict
+    lookup per distinct prefix length, however many rules there are.
+    """
+
+    def __init__(self):
+        self.exact = {}
+        self.prefixes = {}
+        self.always = []
+
+    def add(self, number, rule):
+        """Index rule, which is the number'th rule of the pipeline."""
+        path = rule.get("path")
+        match = rule.get("match", "exact")
+        if not path:
+            self.always.append(number)
+        elif match == "exact":
+            self.exact.setdefault(path, []).append(number)
+        else:
+            prefix = path
+            pattern = None
+            if match == "glob":
+                prefix = GLOB_SPECIAL.split(path, 1)[0]
+                pattern = re.compile(fnmatch.translate(path)).match
+            by_prefix = self.prefixes.setdefault(len(prefix), {})
+            by_prefix.setdefault(prefix, []).append((number, pattern))
+
+    def match(self, path):
+        """Return the numbers of the rules that match path, in order."""
+        found = self.always + self.exact.get(path, [])
+        for length, by_prefix in self.prefixes.items():
+            for number, pattern in by_prefix.get(path[:length], ()):
+                if pattern is None or pattern(path):
+                    found.append(number)
+        return sorted(found)
+
 
 class InstallsArrayFineTuning(Processor):
     """Change an installs array to allow fine-tuning of a type."""
@@ -25,38 +74,164 @@ class InstallsArrayFineTuning(Processor):
             "description": ("Dictionary containing an installs array."),
         },
         "changes": {
-            "required": True,
+            "required": False,
             "description": (
                 "List of dictionaries containing replacement values "
                 "for installs types. Each dictionary must contain a "
-                "path and the new type."
+                "path and the new type. An optional match key of "
+                '"prefix" or "glob" (shell-style, where * also matches /) '
+                "changes every install whose path matches, instead of the "
+                'default "exact". Later changes win over earlier ones.'
+            ),
+        },
+        "transforms": {
+            "required": False,
+            "description": (
+                "List of rules applied in order after changes. Each rule "
+                "has an action and an optional path and match, as in "
+                "changes; a rule without a path applies to every install. "
+                'Actions are "set_type" (with type), "drop", '
+                '"rewrite_prefix" (replaces the path prefix with '
+                'replacement), "set_key" (sets key to value) and '
+                '"strip_key" (removes key).'
             ),
         },
     }
 
     output_variables = {
-        "changed_pkginfo": {"description": "Fine tuned additional_pkginfo dictionary."}
+        "changed_pkginfo": {"description": "Fine tuned installs array."},
+        "changed_additional_pkginfo": {
+            "description": (
+                "Copy of the additional_pkginfo dictionary with the fine "
+                "tuned installs array."
+            )
+        },
+        "unmatched_changes": {
+            "description": "List of changes and transforms that matched nothing."
+        },
     }
 
     __doc__ = description
 
+    def check_rule(self, rule):
+        """Validate one rule before anything is changed."""
+        action = rule.get("action")
+        if action not in ACTIONS:
+            raise ProcessorError("Unknown action in transform: %s" % rule)
+        if rule.get("match", "exact") not in MATCH_TYPES:
+            raise ProcessorError("Unknown match type in transform: %s" % rule)
+        if action == "set_type" and not rule.get("type", None):
+            raise ProcessorError("No type found in change!")
+        if action == "rewrite_prefix" and not (
+            rule.get("path") and "replacement" in rule
+        ):
+            raise ProcessorError("rewrite_prefix needs a path and replacement!")
+        if action in ("set_key", "strip_key") and rule.get("key") in (None, "path"):
+            raise ProcessorError("%s needs a key other than path!" % action)
+        if action == "set_key" and "value" not in rule:
+            raise ProcessorError("No value found in transform: %s" % rule)
+
+    def compile_rules(self):
+        """Turn changes and transforms into an ordered pipeline of stages.
+
+        Returns the rules, the changes and transforms they came from, and
+        the stages. Each change becomes a set_type rule. A rewrite_prefix
+        rule ends its stage, so the rules after it see the new path.
+        """
+        sources = []
+        rules = []
+        for change in self.env.get("changes") or []:
+            if not change.get("path", None):
+                raise ProcessorError("No path found in change!")
+            sources.append(change)
+            rules.append(dict(change, action="set_type"))
+        for transform in self.env.get("transforms") or []:
+            sources.append(transform)
+            if transform.get("action") == "rewrite_prefix":
+                transform = dict(transform, match="prefix")
+            rules.append(transform)
+        stages = [RuleIndex()]
+        for number, rule in enumerate(rules):
+            self.check_rule(rule)
+            stages[-1].add(number, rule)
+            if rule["action"] == "rewrite_prefix":
+                stages.append(RuleIndex())
+        return rules, sources, stages
+
+    def apply_rule(self, rule, install):
+        """Apply one matching rule to install, which is already a copy.
+
+        Returns None if the install is dropped.
+        """
+        action = rule["action"]
+        path = install.get("path", "")
+        if action == "drop":
+            self.output("Dropping %s" % path, verbose_level=2)
+            return None
+        if action == "set_type":
+            install["type"] = rule["type"]
+            self.output("Replacing type for %s to %s" % (path, rule["type"]))
+        elif action == "rewrite_prefix":
+            install["path"] = rule["replacement"] + path[len(rule["path"]) :]
+            self.output("Rewriting %s to %s" % (path, install["path"]), verbose_level=2)
+        elif action == "set_key":
+            install[rule["key"]] = rule["value"]
+            self.output("Setting %s for %s" % (rule["key"], path), verbose_level=2)
+        elif rule["key"] in install:
+            del install[rule["key"]]
+            self.output("Removing %s for %s" % (rule["key"], path), verbose_level=2)
+        return install
+
+    def transform(self, installs, rules, stages):
+        """Run every install through the pipeline in a single pass.
+
+        An install is copied the first time a rule matches it; untouched
+        installs are passed through as they are, and the input is never
+        modified. Returns the new installs array and the set of rule
+        numbers that matched something.
+        """
+        result = []
+        used = set()
+        for install in installs:
+            copied = False
+            for stage in stages:
+                numbers = stage.match(install.get("path", ""))
+                if not numbers:
+                    continue
+                used.update(numbers)
+                if not copied:
+                    install = dict(install)
+                    copied = True
+                for number in numbers:
+                    install = self.apply_rule(rules[number], install)
+                    if install is None:
+                        break
+                if install is None:
+                    break
+            if install is not None:
+                result.append(install)
+        return result, used
+
     def main(self):
         """Magic."""
-        current = self.env["additional_pkginfo"]["installs"]
-        changes = self.env["changes"]
-        for change in changes:
-            path = change.get("path", None)
-            if not path:
-                raise ProcessorError("No path found in change!")
-            newtype = change.get("type", None)
-            if not newtype:
-                raise ProcessorError("No type found in change!")
-            # Replace the installs
-            for install in current:
-                if install["path"] == path:
-                    install["type"] = newtype
-                    self.output("Replacing type for %s to %s" % (path, newtype))
-        self.env["changed_pkginfo"] = current
+        pkginfo = self.env["additional_pkginfo"]
+        rules, sources, stages = self.compile_rules()
+        installs, used = self.transform(pkginfo["installs"], rules, stages)
+        unmatched = [
+            source for number, source in enumerate(sources) if number not in used
+        ]
+        for source in unmatched:
+            self.output("No installs matched %s" % source.get("path"))
+        self.output(
+            "Installs array went from %d to %d entries"
+            % (len(pkginfo["installs"]), len(installs)),
+            verbose_level=2,
+        )
+        changed_additional_pkginfo = dict(pkginfo)
+        changed_additional_pkginfo["installs"] = installs
+        self.env["unmatched_changes"] = unmatched
+        self.env["changed_pkginfo"] = installs
+        self.env["changed_additional_pkginfo"] = changed_additional_pkginfo
 
 
 if __name__ == "__main__":
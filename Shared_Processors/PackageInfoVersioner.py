@@ -13,12 +13,122 @@
 
 from __future__ import absolute_import
 
-from xml.dom import minidom
+import bz2
+import lzma
+import struct
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
 
 from autopkglib import Processor, ProcessorError
 
 __all__ = ["PackageInfoVersioner"]
 
+CHUNK_SIZE = 64 * 1024
+# Component PackageInfos are read on a thread pool from this many on.
+PARALLEL_COMPONENTS = 8
+# Flat packages are xar archives: a fixed big-endian header (magic, header
+# size, version, compressed and uncompressed TOC length, checksum type),
+# then the zlib-compressed XML table of contents, then the heap of files.
+XAR_MAGIC = b"xar!"
+XAR_HEADER = struct.Struct(">4sHHQQI")
+XAR_DECOMPRESSORS = {
+    "application/octet-stream": None,
+    "application/x-gzip": zlib.decompressobj,
+    "application/x-bzip2": bz2.BZ2Decompressor,
+    "application/x-lzma": lzma.LZMADecompressor,
+    "application/x-xz": lzma.LZMADecompressor,
+}
+
+
+class XarArchive(object):
+    """Read individual files out of a xar archive.
+
+    Only the header and the table of contents are read when the archive
+    is opened. A file's data is read from the heap and decompressed when
+    it is asked for, so the rest of the archive is never touched.
+    """
+
+    def __init__(self, fileref):
+        header = fileref.read(XAR_HEADER.size)
+        if len(header) < XAR_HEADER.size or not header.startswith(XAR_MAGIC):
+            raise ValueError("Not a xar archive")
+        _, header_size, _, toc_length, _, _ = XAR_HEADER.unpack(header)
+        fileref.seek(header_size)
+        try:
+            toc = ElementTree.fromstring(zlib.decompress(fileref.read(toc_length)))
+        except ElementTree.ParseError as err:
+            raise ValueError("Can't parse table of contents: %s" % err)
+        if toc.find("toc") is None:
+            raise ValueError("Table of contents has no toc element")
+        self.fileref = fileref
+        self.path = getattr(fileref, "name", None)
+        self.heap_offset = header_size + toc_length
+        # Path in the archive -> (heap offset, archived length, encoding).
+        self.entries = OrderedDict()
+        self.add_entries(toc.find("toc"), "")
+
+    def add_entries(self, parent, prefix):
+        """Record the files under a TOC element, recursing into directories."""
+        for element in parent.findall("file"):
+            name = prefix + element.findtext("name", "")
+            data = element.find("data")
+            if element.findtext("type") == "file" and data is not None:
+                encoding = data.find("encoding")
+                try:
+                    offset = int(data.findtext("offset"))
+                    length = int(data.findtext("length"))
+                except (TypeError, ValueError):
+                    raise ValueError("Bad offset or length for %s" % name)
+                self.entries[name] = (
+                    offset,
+                    length,
+                    encoding.get("style") if encoding is not None else None,
+                )
+            self.add_entries(element, name + "/")
+
+    def chunks(self, name, fileref=None):
+        """Yield the decompressed contents of a file in the archive.
+
+        fileref, if given, is another open handle on the same archive, so
+        several files can be read at once from different threads.
+        """
+        fileref = fileref or self.fileref
+        offset, remaining, encoding = self.entries[name]
+        if encoding not in XAR_DECOMPRESSORS:
+            raise ValueError("Unsupported encoding %s for %s" % (encoding, name))
+        decompressor = XAR_DECOMPRESSORS[encoding]
+        decompressor = decompressor() if decompressor else None
+        fileref.seek(self.heap_offset + offset)
+        while remaining:
+            chunk = fileref.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise ValueError("%s is truncated" % name)
+            remaining -= len(chunk)
+            if decompressor is None:
+                yield chunk
+                continue
+            for piece in self.inflate(decompressor, chunk):
+                yield piece
+
+    def inflate(self, decompressor, chunk):
+        """Decompress chunk in pieces of at most CHUNK_SIZE bytes.
+
+        Highly compressible XML can expand a lot, so this keeps the
+        parser from being handed far more than it needs at once.
+        """
+        if hasattr(decompressor, "unconsumed_tail"):
+            # zlib
+            while chunk:
+                yield decompressor.decompress(chunk, CHUNK_SIZE)
+                chunk = decompressor.unconsumed_tail
+        else:
+            # bz2 and lzma
+            yield decompressor.decompress(chunk, CHUNK_SIZE)
+            while not (decompressor.needs_input or decompressor.eof):
+                yield decompressor.decompress(b"", CHUNK_SIZE)
+
 
 class PackageInfoVersioner(Processor):
     """Get version from a PackageInfo file in a distribution/bundle package."""
@@ -28,10 +138,31 @@ class PackageInfoVersioner(Processor):
         "package_info_path": {
             "required": True,
             "description": (
-                "Path to PackageInfo file inside a distribution",
-                "/bundle package.",
+                "Path to PackageInfo file inside a distribution/bundle "
+                "package, or to a flat package. For a flat package the "
+                "PackageInfo is read straight out of the archive: the "
+                "package's own, or else that of its first component, or "
+                "else the first versioned pkg-ref in its Distribution."
+            ),
+        },
+        "all_components": {
+            "required": False,
+            "default": False,
+            "description": (
+                "Also read the PackageInfo of every component of a flat "
+                "distribution package, setting components and "
+                "component_versions. pkg_id and version still come from "
+                "the first one. Defaults to False."
+            ),
+        },
+        "worker_count": {
+            "required": False,
+            "description": (
+                "Number of threads used to read component PackageInfos "
+                "when there are %d or more. Defaults to the Python thread "
+                "pool default." % PARALLEL_COMPONENTS
             ),
-        }
+        },
     }
     output_variables = {
         "pkg_id": {
@@ -39,21 +170,139 @@ class PackageInfoVersioner(Processor):
         },
         "version": {
             "description": "Version returned from pkg-info field in PackageInfo."
-        }
+        },
+        "components": {
+            "description": (
+                "all_components only. List of dictionaries with the "
+                "identifier, version and path of each component's PackageInfo."
+            )
+        },
+        "component_versions": {
+            "description": "all_components only. Dictionary of identifier to version."
+        },
     }
 
     __doc__ = description
 
+    def read_tag(self, chunks, tag="pkg-info", attribute=None):
+        """Return the attributes of the first tag element in an XML stream.
+
+        chunks is an iterable of bytes. The XML is parsed incrementally
+        and parsing stops at the first matching start tag (one that has
+        attribute, if given). In a PackageInfo that is the root element,
+        so the payload and bundle sections after it are never read.
+        """
+        parser = ElementTree.XMLPullParser(events=("start",))
+        try:
+            for chunk in chunks:
+                parser.feed(chunk)
+                for _, element in parser.read_events():
+                    if element.tag == tag and (
+                        attribute is None or attribute in element.attrib
+                    ):
+                        return dict(element.attrib)
+            parser.close()
+        except ElementTree.ParseError as err:
+            raise ProcessorError("Can't parse %s: %s" % (tag, err))
+        raise ProcessorError("No %s tag found" % tag)
+
+    def read_entry(self, archive, name, fileref=None):
+        """Return pkg-info attributes from one PackageInfo in an archive.
+
+        Without fileref the archive is opened again, so that entries can be
+        read on several threads at once.
+        """
+        if fileref is None:
+            with open(archive.path, "rb") as fileref:
+                return self.read_entry(archive, name, fileref)
+        self.output("Reading %s from archive" % name, verbose_level=2)
+        pkg_info = self.read_tag(archive.chunks(name, fileref))
+        pkg_info["path"] = name
+        return pkg_info
+
+    def read_archive(self, fileref):
+        """Return pkg-info attributes from a flat package, as a list.
+
+        The list has the package's own PackageInfo, or those of its
+        components in archive order; only the first one unless
+        all_components is set. A distribution without component
+        PackageInfos falls back to its first versioned pkg-ref.
+        """
+        archive = XarArchive(fileref)
+        names = [
+            name
+            for name in archive.entries
+            if name == "PackageInfo"
+            or (name.count("/") == 1 and name.endswith(".pkg/PackageInfo"))
+        ]
+        if not self.env.get("all_components"):
+            names = names[:1]
+        if len(names) >= PARALLEL_COMPONENTS:
+            workers = self.env.get("worker_count")
+            with ThreadPoolExecutor(
+                max_workers=int(workers) if workers else None
+            ) as pool:
+                return list(pool.map(self.read_entry, [archive] * len(names), names))
+        if names:
+            return [self.read_entry(archive, name, fileref) for name in names]
+        if "Distribution" in archive.entries:
+            self.output("Reading Distribution from archive", verbose_level=2)
+            pkg_ref = self.read_tag(
+                archive.chunks("Distribution"), "pkg-ref", "version"
+            )
+            return [
+                {
+                    "identifier": pkg_ref.get("id"),
+                    "version": pkg_ref["version"],
+                    "path": "Distribution",
+                }
+            ]
+        raise ProcessorError("No PackageInfo or Distribution in package")
+
     def main(self):
+        path = self.env["package_info_path"]
         try:
-            dom = minidom.parse(self.env["package_info_path"])
-        except IOError as err:
+            with open(path, "rb") as fileref:
+                if fileref.read(len(XAR_MAGIC)) == XAR_MAGIC:
+                    fileref.seek(0)
+                    found = self.read_archive(fileref)
+                else:
+                    fileref.seek(0)
+                    pkg_info = self.read_tag(
+                        iter(lambda: fileref.read(CHUNK_SIZE), b"")
+                    )
+                    pkg_info["path"] = path
+                    found = [pkg_info]
+        except (IOError, OSError) as err:
             raise ProcessorError(err)
-        pkgrefs = dom.getElementsByTagName("pkg-info")
-        self.env["pkg_id"] = pkgrefs[0].attributes["identifier"].value
-        self.output("Found pkg_id %s" % self.env["pkg_id"]) 
-        self.env["version"] = pkgrefs[0].attributes["version"].value
-        self.output("Found version %s" % self.env["version"])
+        except (ValueError, KeyError, struct.error, zlib.error, lzma.LZMAError) as err:
+            raise ProcessorError("Can't read package %s: %s" % (path, err))
+        pkg_info = found[0]
+        if self.env.get("all_components"):
+            components = [
+                {
+                    "identifier": item.get("identifier"),
+                    "version": item.get("version"),
+                    "path": item["path"],
+                }
+                for item in found
+            ]
+            self.env["components"] = components
+            self.env["component_versions"] = dict(
+                (item["identifier"], item["version"]) for item in components
+            )
+            for item in components:
+                self.output(
+                    "Found component %s version %s"
+                    % (item["identifier"], item["version"])
+                )
+        try:
+            self.env["pkg_id"] = pkg_info["identifier"]
+            self.output("Found pkg_id %s" % self.env["pkg_id"])
+            self.env["version"] = pkg_info["version"]
+            self.output("Found version %s" % self.env["version"])
+        except KeyError as err:
+            raise ProcessorError("pkg-info tag has no %s attribute" % err)
 
 
 if __name__ == "__main__":
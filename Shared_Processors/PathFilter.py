@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.#
+"""Include/exclude path matching shared by the directory listing processors.
+
+This is not a processor. SubDirectoryList and DirectoryList import it from
+their own directory.
+"""
+
+from __future__ import absolute_import
+
+import re
+
+__all__ = ["PathFilter"]
+
+
+def translate(pattern):
+    """Translate one gitignore-style pattern into a regular expression.
+
+    Returns (regex, dir_only). A pattern containing a slash is anchored at
+    the root, otherwise it matches a name at any depth. "*" and "?" stay
+    within a path segment, "**" crosses segments, and a trailing slash
+    only matches directories.
+    """
+    dir_only = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    parts = [] if anchored else ["(?:.*/)?"]
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if pattern.startswith("**/", index):
+            parts.append("(?:.*/)?")
+            index += 3
+            continue
+        if pattern.startswith("**", index):
+            parts.append(".*")
+            index += 2
+            continue
+        if char == "*":
+            parts.append("[^/]*")
+        elif char == "?":
+            parts.append("[^/]")
+        elif char == "[" and "]" in pattern[index + 2 :]:
+            end = pattern.index("]", index + 2)
+            body = pattern[index + 1 : end]
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            parts.append("[%s]" % body.replace("\\", "\\\\"))
+            index = end
+        else:
+            parts.append(re.escape(char))
+        index += 1
+    return "".join(parts), dir_only
+
+
+class PathFilter(object):
+    """Decide which relative paths a walk keeps.
+
+    All patterns of a kind are compiled into a single alternation, so each
+    path costs one regex match no matter how many patterns there are.
+    Exclude patterns apply to files and directories; an excluded directory
+    should not be descended into at all. Include patterns, if any, apply
+    to files only.
+    """
+
+    def __init__(self, include=None, exclude=None):
+        self.include = self.compile(include or [], files=True)
+        self.exclude_files = self.compile(exclude or [], files=True)
+        self.exclude_dirs = self.compile(exclude or [], files=False)
+
+    @staticmethod
+    def compile(patterns, files):
+        """Compile patterns into one regex, or None if nothing applies."""
+        regexes = []
+        for pattern in patterns:
+            regex, dir_only = translate(pattern)
+            if not (files and dir_only):
+                regexes.append(regex)
+        if not regexes:
+            return None
+        return re.compile("(?:%s)\\Z" % "|".join(regexes), re.DOTALL).match
+
+    def keep_dir(self, relpath):
+        """Return True if a directory should be kept and descended into."""
+        return self.exclude_dirs is None or not self.exclude_dirs(relpath)
+
+    def keep_file(self, relpath):
+        """Return True if a file should be kept."""
+        if self.exclude_files is not None and self.exclude_files(relpath):
+            return False
+        return self.include is None or bool(self.include(relpath))
@@ -11,12 +11,55 @@
 
 from __future__ import absolute_import
 
+import errno
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import stat
 import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from autopkglib import Processor, ProcessorError
 
 __all__ = ["Rsync"]
 
+# Buffer size for the fallback copy loop and content comparisons.
+CHUNK_SIZE = 1024 * 1024
+SYNC_ENGINES = ("rsync", "python")
+# Linux ioctl that makes a file share another file's data blocks (reflink).
+FICLONE = 0x40049409
+# ioctl errors meaning reflinks won't work on this filesystem at all.
+REFLINK_UNSUPPORTED = (
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EINVAL,
+    errno.EXDEV,
+    errno.ENOSYS,
+)
+# One line of rsync --info=progress2 output, e.g.
+#   1,238,099  12%  1.07MB/s  0:00:01 (xfr#4, to-chk=81/92)
+PROGRESS_RE = re.compile(
+    r"\s*([\d,]+)\s+(\d+)%\s+(\S+/s)\s+(\d+:\d\d:\d\d)"
+    r"(?:\s+\(xfr#(\d+), (?:ir|to)-chk=\d+/\d+\))?"
+)
+# Totals printed by rsync --stats.
+RSYNC_STATS = {
+    "Number of files transferred": "files_copied",
+    "Number of regular files transferred": "files_copied",
+    "Total transferred file size": "bytes_transferred",
+}
+RSYNC_STATS_RE = re.compile(r"(%s): ([\d,]+)" % "|".join(RSYNC_STATS))
+# Seconds between progress lines while rsync runs.
+PROGRESS_INTERVAL = 5
+# Files at least this big are copied on the calling thread in parallel mode.
+LARGE_FILE_SIZE = 8 * 1024 * 1024
+
 
 class Rsync(Processor):
     """Rsyncs a path to another path."""
@@ -39,25 +82,557 @@ class Rsync(Processor):
             "required": False,
             "description": ("Custom path to rsync. Defaults to /usr/bin/rsync."),
         },
+        "sync_engine": {
+            "required": False,
+            "default": "rsync",
+            "description": (
+                'Either "rsync" to run the rsync binary (the default), or '
+                '"python" to use the built-in engine, which behaves like '
+                "rsync -a and needs no external binary. rsync_arguments and "
+                "rsync_path only apply to rsync."
+            ),
+        },
+        "sync_checksum": {
+            "required": False,
+            "default": False,
+            "description": (
+                "python engine only. Compare file contents instead of size "
+                "and modification time to decide what to copy, like rsync "
+                "--checksum. Defaults to False."
+            ),
+        },
+        "sync_delete": {
+            "required": False,
+            "default": False,
+            "description": (
+                "python engine only. Delete files in destination_path that "
+                "don't exist in source_path, like rsync --delete. Defaults "
+                "to False."
+            ),
+        },
+        "parallel_copy": {
+            "required": False,
+            "default": False,
+            "description": (
+                "python engine only. Copy files smaller than large_file_size "
+                "on a thread pool while larger files are copied one at a "
+                "time. Directories are still created in walk order. "
+                "Defaults to False."
+            ),
+        },
+        "worker_count": {
+            "required": False,
+            "description": (
+                "Number of threads used by parallel_copy. Defaults to the "
+                "Python thread pool default."
+            ),
+        },
+        "large_file_size": {
+            "required": False,
+            "default": LARGE_FILE_SIZE,
+            "description": (
+                "Size in bytes from which parallel_copy copies a file on the "
+                "main thread instead of the pool. Defaults to %d." % LARGE_FILE_SIZE
+            ),
+        },
+        "sync_reflink": {
+            "required": False,
+            "default": False,
+            "description": (
+                "python engine only. Clone changed files with a reflink "
+                "(FICLONE) so they share data blocks with the source instead "
+                "of being copied. Falls back to link_dest or a normal copy "
+                "where the filesystem doesn't support it. Linux only. "
+                "Defaults to False."
+            ),
+        },
+        "link_dest": {
+            "required": False,
+            "description": (
+                "python engine only. Path to a previous copy of the "
+                "destination. Files that are unchanged there are hardlinked "
+                "into destination_path instead of copied, like rsync "
+                "--link-dest. Must be on the same filesystem as "
+                "destination_path."
+            ),
+        },
+    }
+    output_variables = {
+        "sync_stats": {
+            "description": (
+                "Dictionary with files_copied, bytes_transferred, elapsed "
+                "(seconds), bytes_per_second and files_per_second. The "
+                "python engine adds files_cloned, files_linked, "
+                "files_skipped, bytes_skipped, links_created and "
+                "files_deleted. With rsync the counts are read from "
+                "--info=progress2 or --stats output, and are 0 without "
+                "either."
+            )
+        }
     }
-    output_variables = {}
 
     __doc__ = description
 
+    def same_contents(self, source, destination):
+        """Returns True if two files have identical contents."""
+        digests = []
+        for path in (source, destination):
+            hasher = hashlib.sha1()
+            with open(path, "rb") as fileref:
+                for chunk in iter(lambda: fileref.read(CHUNK_SIZE), b""):
+                    hasher.update(chunk)
+            digests.append(hasher.digest())
+        return digests[0] == digests[1]
+
+    def unchanged(self, source, source_stat, destination):
+        """Returns True if destination already matches source."""
+        try:
+            dest_stat = os.lstat(destination)
+        except OSError:
+            return False
+        if not stat.S_ISREG(dest_stat.st_mode):
+            return False
+        if dest_stat.st_size != source_stat.st_size:
+            return False
+        if self.env.get("sync_checksum"):
+            return self.same_contents(source, destination)
+        # Whole seconds, like rsync, so filesystems with coarse timestamps
+        # don't cause every file to be copied again.
+        return int(dest_stat.st_mtime) == int(source_stat.st_mtime)
+
+    def copy_data(self, fsrc, fdst, size):
+        """Copy size bytes between two open files.
+
+        Uses copy_file_range or sendfile where the platform has them, so
+        data moves inside the kernel without passing through Python.
+        Falls back to a buffered copy if neither works for these files.
+        """
+        infd = fsrc.fileno()
+        outfd = fdst.fileno()
+        copied = 0
+        if hasattr(os, "copy_file_range"):
+            try:
+                while copied < size:
+                    sent = os.copy_file_range(infd, outfd, size - copied)
+                    if not sent:
+                        break
+                    copied += sent
+                return
+            except OSError:
+                if copied:
+                    raise
+        if sys.platform.startswith("linux"):
+            try:
+                while copied < size:
+                    sent = os.sendfile(outfd, infd, copied, size - copied)
+                    if not sent:
+                        break
+                    copied += sent
+                return
+            except OSError:
+                if copied:
+                    raise
+        shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+
+    def clone_data(self, fsrc, fdst):
+        """Try to make fdst share fsrc's data blocks with a reflink.
+
+        Returns True on success. If the filesystem can't reflink at all,
+        reflinks are switched off for the rest of the sync so each file
+        doesn't pay for a failing ioctl.
+        """
+        if not self.reflink:
+            return False
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except (IOError, OSError) as err:
+            if err.errno in REFLINK_UNSUPPORTED:
+                self.output("Reflinks not supported here, copying instead")
+                self.reflink = False
+            return False
+        return True
+
+    def temp_path(self, destination):
+        """Return the temporary path a file is written to before renaming."""
+        return os.path.join(
+            os.path.dirname(destination),
+            ".%s.%d.tmp" % (os.path.basename(destination), os.getpid()),
+        )
+
+    def link_file(self, link_path, destination):
+        """Hardlink link_path into place at destination.
+
+        Returns False if the link can't be made, e.g. across filesystems.
+        The new name is renamed over destination, so an existing file is
+        never written through and shared inodes are left alone.
+        """
+        tmp_path = self.temp_path(destination)
+        try:
+            os.link(link_path, tmp_path)
+        except OSError:
+            return False
+        try:
+            if os.path.isdir(destination) and not os.path.islink(destination):
+                shutil.rmtree(destination)
+            os.rename(tmp_path, destination)
+        except OSError as err:
+            os.unlink(tmp_path)
+            raise ProcessorError("Can't link %s: %s" % (link_path, err))
+        return True
+
+    def copy_file(self, source, source_stat, destination):
+        """Copy a file through a temporary file, keeping mode and times.
+
+        Returns "files_cloned" if the data was reflinked, otherwise
+        "files_copied".
+        """
+        tmp_path = self.temp_path(destination)
+        result = "files_cloned"
+        try:
+            with open(source, "rb") as fsrc, open(tmp_path, "wb") as fdst:
+                if not self.clone_data(fsrc, fdst):
+                    self.copy_data(fsrc, fdst, source_stat.st_size)
+                    result = "files_copied"
+            os.chmod(tmp_path, stat.S_IMODE(source_stat.st_mode))
+            os.utime(tmp_path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+            if os.path.isdir(destination) and not os.path.islink(destination):
+                shutil.rmtree(destination)
+            os.rename(tmp_path, destination)
+        except (IOError, OSError) as err:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise ProcessorError("Can't copy %s: %s" % (source, err))
+        return result
+
+    def update_metadata(self, source_stat, destination):
+        """Give an unchanged destination file source's mode and times.
+
+        The data is skipped when size and mtime match, but a chmod, or an
+        mtime that only differs below a second, still has to be applied.
+        """
+        dest_stat = os.lstat(destination)
+        mode = stat.S_IMODE(source_stat.st_mode)
+        if stat.S_IMODE(dest_stat.st_mode) != mode:
+            os.chmod(destination, mode)
+        if dest_stat.st_mtime_ns != source_stat.st_mtime_ns:
+            os.utime(destination, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+
+    def linkable(self, source, source_stat, link_path):
+        """Return True if link_path is an identical copy of source.
+
+        The mode has to match too, since a hardlink shares it.
+        """
+        try:
+            link_stat = os.lstat(link_path)
+        except OSError:
+            return False
+        if link_stat.st_mode != source_stat.st_mode:
+            return False
+        return self.unchanged(source, source_stat, link_path)
+
+    def sync_entry(self, source, destination, source_stat=None, link_path=None):
+        """Sync a single file or symlink.
+
+        A changed file is reflinked if sync_reflink is on and works here,
+        otherwise hardlinked from link_path if that copy is unchanged, and
+        copied as a last resort. Returns (stat_name, size) for the stats
+        dict, or None if the entry was skipped as a special file. Touches
+        no shared state, so it can run on a worker thread.
+        """
+        if source_stat is None:
+            source_stat = os.lstat(source)
+        if stat.S_ISLNK(source_stat.st_mode):
+            target = os.readlink(source)
+            if os.path.islink(destination) and os.readlink(destination) == target:
+                return ("files_skipped", 0)
+            self.remove(destination)
+            os.symlink(target, destination)
+            if os.utime in os.supports_follow_symlinks:
+                os.utime(
+                    destination,
+                    ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns),
+                    follow_symlinks=False,
+                )
+            return ("links_created", 0)
+        if stat.S_ISREG(source_stat.st_mode):
+            if self.unchanged(source, source_stat, destination):
+                self.update_metadata(source_stat, destination)
+                return ("files_skipped", source_stat.st_size)
+            if os.path.islink(destination):
+                os.unlink(destination)
+            if (
+                link_path is not None
+                and not self.reflink
+                and self.linkable(source, source_stat, link_path)
+                and self.link_file(link_path, destination)
+            ):
+                return ("files_linked", source_stat.st_size)
+            result = self.copy_file(source, source_stat, destination)
+            return (result, source_stat.st_size)
+        self.output("Skipping special file %s" % source)
+        return None
+
+    def tally(self, stats, result):
+        """Add a sync_entry result to stats."""
+        if result is None:
+            return
+        name, size = result
+        stats[name] += 1
+        if name == "files_copied":
+            stats["bytes_transferred"] += size
+        elif name == "files_skipped":
+            stats["bytes_skipped"] += size
+
+    def remove(self, path):
+        """Remove a file, symlink or directory tree if it exists."""
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.unlink(path)
+
+    def sync_tree(self, source, destination, stats, pool=None):
+        """Sync the contents of directory source into destination.
+
+        With a pool, files smaller than large_file_size are handed to it
+        and larger ones are copied here, so a few big files don't hold up
+        the small ones. Directories are always created on this thread in
+        walk order, before any of their files are queued.
+        """
+        destination = os.path.normpath(destination)
+        large_file_size = int(self.env.get("large_file_size") or LARGE_FILE_SIZE)
+        # Bound the number of outstanding futures on very large trees.
+        max_pending = 4096
+        link_dest = self.env.get("link_dest")
+        pending = deque()
+        expected = set()
+        directories = []
+        for dirpath, dirnames, filenames in os.walk(source):
+            relpath = os.path.relpath(dirpath, source)
+            dest_dir = os.path.normpath(os.path.join(destination, relpath))
+            if not os.path.isdir(dest_dir) or os.path.islink(dest_dir):
+                self.remove(dest_dir)
+                os.makedirs(dest_dir)
+            # Like rsync, keep the directory writable by its owner until the
+            # final pass, so read-only source directories can be synced
+            # into again on the next run.
+            dest_mode = stat.S_IMODE(os.stat(dest_dir).st_mode)
+            if dest_mode & stat.S_IRWXU != stat.S_IRWXU:
+                os.chmod(dest_dir, dest_mode | stat.S_IRWXU)
+            directories.append((dirpath, dest_dir))
+            expected.add(dest_dir)
+            link_dir = os.path.join(link_dest, relpath) if link_dest else None
+            for name in filenames + [
+                x for x in dirnames if os.path.islink(os.path.join(dirpath, x))
+            ]:
+                source_path = os.path.join(dirpath, name)
+                dest_path = os.path.join(dest_dir, name)
+                expected.add(dest_path)
+                link_path = os.path.join(link_dir, name) if link_dir else None
+                source_stat = os.lstat(source_path)
+                if pool is None or source_stat.st_size >= large_file_size:
+                    self.tally(
+                        stats,
+                        self.sync_entry(source_path, dest_path, source_stat, link_path),
+                    )
+                    continue
+                pending.append(
+                    pool.submit(
+                        self.sync_entry, source_path, dest_path, source_stat, link_path
+                    )
+                )
+                while len(pending) > max_pending:
+                    self.tally(stats, pending.popleft().result())
+        while pending:
+            self.tally(stats, pending.popleft().result())
+        if self.env.get("sync_delete"):
+            self.delete_extraneous(destination, expected, stats)
+        # Directory modes and times last, deepest first, since writing into a
+        # directory updates its mtime.
+        for dirpath, dest_dir in reversed(directories):
+            source_stat = os.stat(dirpath)
+            os.chmod(dest_dir, stat.S_IMODE(source_stat.st_mode))
+            os.utime(dest_dir, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+
+    def delete_extraneous(self, destination, expected, stats):
+        """Delete everything under destination that isn't in expected.
+
+        Extraneous paths are collected in one walk and removed together
+        afterwards; extraneous directories are removed whole without
+        walking into them.
+        """
+        extraneous = []
+        for dirpath, dirnames, filenames in os.walk(destination):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if path not in expected:
+                    extraneous.append(path)
+            for name in list(dirnames):
+                path = os.path.join(dirpath, name)
+                if path not in expected:
+                    extraneous.append(path)
+                    dirnames.remove(name)
+        for path in extraneous:
+            self.output("Deleting %s" % path, verbose_level=2)
+            self.remove(path)
+        stats["files_deleted"] += len(extraneous)
+
+    def python_sync(self, source, destination):
+        """Sync source to destination without the rsync binary.
+
+        Follows rsync's rules: a directory source with a trailing slash
+        copies its contents into destination, without one it is copied
+        into destination under its own name. Files are copied when their
+        size or mtime differ (or contents, with sync_checksum).
+        """
+        stats = {
+            "files_copied": 0,
+            "bytes_transferred": 0,
+            "files_cloned": 0,
+            "files_linked": 0,
+            "files_skipped": 0,
+            "bytes_skipped": 0,
+            "links_created": 0,
+            "files_deleted": 0,
+        }
+        if not os.path.lexists(source):
+            raise ProcessorError("Can't find source_path %s" % source)
+        self.reflink = False
+        if self.env.get("sync_reflink"):
+            # FICLONE is a Linux ioctl number; don't send it anywhere else.
+            self.reflink = sys.platform.startswith("linux")
+        link_dest = self.env.get("link_dest")
+        if link_dest and not os.path.isdir(link_dest):
+            self.output("link_dest %s doesn't exist, ignoring it" % link_dest)
+            self.env["link_dest"] = link_dest = None
+        try:
+            if os.path.isdir(source) and not os.path.islink(source):
+                if not source.endswith(os.sep):
+                    destination = os.path.join(destination, os.path.basename(source))
+                if self.env.get("parallel_copy"):
+                    workers = self.env.get("worker_count")
+                    with ThreadPoolExecutor(
+                        max_workers=int(workers) if workers else None
+                    ) as pool:
+                        self.sync_tree(source, destination, stats, pool)
+                else:
+                    self.sync_tree(source, destination, stats)
+            else:
+                if os.path.isdir(destination):
+                    destination = os.path.join(destination, os.path.basename(source))
+                link_path = None
+                if link_dest:
+                    link_path = os.path.join(link_dest, os.path.basename(destination))
+                self.tally(stats, self.sync_entry(source, destination, None, link_path))
+        except (IOError, OSError) as err:
+            raise ProcessorError("Sync failed: %s" % err)
+        return stats
+
+    def rsync_line(self, line, stats):
+        """Handle one line of rsync output."""
+        match = PROGRESS_RE.match(line)
+        if match:
+            stats["bytes_transferred"] = int(match.group(1).replace(",", ""))
+            if match.group(5):
+                stats["files_copied"] = int(match.group(5))
+            now = time.time()
+            if now - self.last_progress >= PROGRESS_INTERVAL:
+                self.last_progress = now
+                self.output(
+                    "%s%% done, %s bytes at %s, ETA %s"
+                    % (match.group(2), match.group(1), match.group(3), match.group(4)),
+                    verbose_level=2,
+                )
+            return
+        match = RSYNC_STATS_RE.search(line)
+        if match:
+            stats[RSYNC_STATS[match.group(1)]] = int(match.group(2).replace(",", ""))
+        if line.strip():
+            self.output(line)
+
+    def run_rsync(self, cmd):
+        """Run rsync, streaming its output instead of buffering all of it.
+
+        stdout is split on carriage returns as well as newlines, since
+        --info=progress2 rewrites its line in place. stderr is drained on
+        a separate thread so neither pipe can fill up and stall rsync.
+        Only a non-zero exit code is treated as a failure.
+        """
+        stats = {"files_copied": 0, "bytes_transferred": 0}
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as err:
+            raise ProcessorError("Can't run %s: %s" % (cmd[0], err))
+        errors = []
+        reader = threading.Thread(target=lambda: errors.append(proc.stderr.read()))
+        reader.daemon = True
+        reader.start()
+        self.last_progress = 0
+        partial = b""
+        for chunk in iter(lambda: proc.stdout.read1(CHUNK_SIZE), b""):
+            lines = re.split(b"[\r\n]", partial + chunk)
+            partial = lines.pop()
+            for line in lines:
+                self.rsync_line(line.decode("utf-8", "replace"), stats)
+        if partial:
+            self.rsync_line(partial.decode("utf-8", "replace"), stats)
+        proc.wait()
+        reader.join()
+        rerr = b"".join(errors).decode("utf-8", "replace").strip()
+        if proc.returncode:
+            raise ProcessorError(
+                "rsync failed with exit code %d: %s" % (proc.returncode, rerr)
+            )
+        if rerr:
+            self.output(rerr)
+        return stats
+
     def main(self):
+        engine = self.env.get("sync_engine") or "rsync"
+        if engine not in SYNC_ENGINES:
+            raise ProcessorError("Unsupported sync_engine: %s" % engine)
+        started = time.time()
+        if engine == "python":
+            stats = self.python_sync(
+                self.env["source_path"], self.env["destination_path"]
+            )
+            self.output(
+                "Copied %d files (%d bytes), cloned %d, hardlinked %d, "
+                "skipped %d unchanged (%d bytes), deleted %d"
+                % (
+                    stats["files_copied"] + stats["links_created"],
+                    stats["bytes_transferred"],
+                    stats["files_cloned"],
+                    stats["files_linked"],
+                    stats["files_skipped"],
+                    stats["bytes_skipped"],
+                    stats["files_deleted"],
+                )
+            )
+        else:
+            stats = self.run_rsync(self.rsync_command())
+        # Floor the elapsed time so a near-instant sync can't divide by zero.
+        elapsed = max(time.time() - started, 0.001)
+        stats["elapsed"] = round(elapsed, 3)
+        stats["bytes_per_second"] = int(stats["bytes_transferred"] / elapsed)
+        stats["files_per_second"] = round(stats["files_copied"] / elapsed, 1)
+        self.env["sync_stats"] = stats
+        self.output(
+            "%d bytes/s, %.1f files/s over %.1f seconds"
+            % (stats["bytes_per_second"], stats["files_per_second"], elapsed),
+            verbose_level=2,
+        )
+
+    def rsync_command(self):
+        """Build the rsync command line from the inputs."""
         rsync_location = self.env.get("rsync_path", "/usr/bin/rsync")
         rsync_args = self.env.get("rsync_arguments", [])
-        if isinstance(rsync_args, basestring):
+        if isinstance(rsync_args, str):
             raise ProcessorError("rsync_args must be a list!")
         cmd = [rsync_location]
         if rsync_args:
             cmd.extend(rsync_args)
         cmd.extend([self.env["source_path"], self.env["destination_path"]])
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        (rout, rerr) = proc.communicate()
-        if rerr:
-            raise ProcessorError(rerr)
-        self.output(rout)
+        return cmd
 
 
 if __name__ == "__main__":
@@ -12,13 +12,41 @@
 # specific processors.
 # pylint: disable=e1101,f0401
 
-import subprocess
+import hashlib
+import json
+import mmap
+import os
+import stat
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
 
 from autopkglib import Processor, ProcessorError
 
 
 __all__ = ["SHAChecksum"]
 
+# Map of `shasum -a` algorithm arguments to hashlib constructor names.
+SHASUM_ALGORITHMS = {
+    "1": "sha1",
+    "224": "sha224",
+    "256": "sha256",
+    "384": "sha384",
+    "512": "sha512",
+    "512224": "sha512_224",
+    "512256": "sha512_256",
+}
+DEFAULT_ALGORITHM = "1"
+# Read size for the streaming hash loop. Large enough to keep syscall
+# overhead negligible, small enough to stay in L2/L3 cache.
+CHUNK_SIZE = 1024 * 1024
+# Slice size when hashing from a memory map. Slices are zero-copy views, this
+# only bounds how long a single update() call runs.
+MMAP_SLICE_SIZE = 64 * 1024 * 1024
+READ_METHODS = ("readinto", "mmap")
+CACHE_FILENAME = "SHAChecksum_cache.json"
+
 
 class SHAChecksum(Processor):
     """Calculate checksum for a file"""
@@ -26,39 +54,439 @@ class SHAChecksum(Processor):
     description = __doc__
     input_variables = {
         "source_file": {
-            "required": True,
-            "description": ("Path to file to calculate checksum on."),
+            "required": False,
+            "description": (
+                "Path to file to calculate checksum on. Required unless "
+                "source_files is set."
+            ),
+        },
+        "source_files": {
+            "required": False,
+            "description": (
+                "Batch mode. A list of paths, or a shell glob pattern, of "
+                "files to calculate checksum_type on. Files are hashed in "
+                "parallel and the results stored in checksums."
+            ),
+        },
+        "worker_count": {
+            "required": False,
+            "description": (
+                "Number of threads used to hash files in batch mode. "
+                "Defaults to the number of CPUs."
+            ),
+        },
+        "source_directory": {
+            "required": False,
+            "description": (
+                "Directory mode. Path to a directory to calculate a Merkle "
+                "digest of. Every file is hashed with checksum_type (using "
+                "the cache), and each directory's digest covers the sorted "
+                "names, types and digests of its entries."
+            ),
+        },
+        "checksum_manifest_path": {
+            "required": False,
+            "description": (
+                "Batch mode. If set, write a shasum-style manifest of all "
+                "digests, sorted by path, to this file."
+            ),
         },
         "checksum_type": {
             "required": False,
             "description": (
-                "Checksum type, will be passed directly to ",
-                "shasum -a. See manpage for available options. "
-                "Defaults to SHA1.",
+                "Checksum type, using the same values as shasum -a "
+                "(1, 224, 256, 384, 512, 512224, 512256). See manpage "
+                "for available options. Defaults to SHA1."
+            ),
+        },
+        "checksum_types": {
+            "required": False,
+            "description": (
+                "List of checksum types to compute in a single read of "
+                "source_file. Accepts the checksum_type values as well as "
+                "other hashlib names such as md5. Each digest is stored in "
+                "checksum_<type>, e.g. checksum_256."
+            ),
+        },
+        "checksum_read_method": {
+            "required": False,
+            "default": "readinto",
+            "description": (
+                "How file contents are fed to the hash. readinto streams "
+                "chunks through a reused buffer; mmap hashes straight from a "
+                "memory map of the file, which avoids copying on very large "
+                "files. mmap falls back to readinto if the file can't be "
+                "mapped. Defaults to readinto."
+            ),
+        },
+        "checksum_cache": {
+            "required": False,
+            "default": True,
+            "description": (
+                "Cache digests on disk, keyed by device, inode, size, mtime "
+                "and algorithm, so unchanged files are not rehashed on the "
+                "next run. Set to False to disable. Defaults to True."
+            ),
+        },
+        "checksum_cache_path": {
+            "required": False,
+            "description": (
+                "Path to the checksum cache file. Defaults to "
+                "%s in RECIPE_CACHE_DIR. In directory mode, an id of "
+                "the tree is added before the extension." % CACHE_FILENAME
+            ),
+        },
+        "checksum_cache_size": {
+            "required": False,
+            "default": 10000,
+            "description": (
+                "Maximum number of entries kept in the checksum cache. The "
+                "least recently used entries are evicted first. "
+                "Entries used by the current run are never evicted, so a "
+                "source_directory larger than this is still fully cached. "
+                "Defaults to 10000."
+            ),
+        },
+        "checksum_verify": {
+            "required": False,
+            "default": False,
+            "description": (
+                "Ignore cached digests and rehash the file, refreshing the "
+                "cache with the result. Defaults to False."
             ),
         },
     }
     output_variables = {
         "checksum": {
-            "description": "Version returned from pkg-info field in PackageInfo."
-        }
+            "description": (
+                "Hex digest of source_file. With checksum_types, the digest "
+                "of the first type listed. In directory mode, the Merkle "
+                "digest of source_directory."
+            )
+        },
+        "checksum_<type>": {
+            "description": "Hex digest for each entry in checksum_types."
+        },
+        "checksums": {
+            "description": (
+                "Batch mode. Dictionary of path to hex digest for every file "
+                "in source_files, ordered by path."
+            )
+        },
     }
 
     __doc__ = description
 
+    def new_hash(self, checksum_type):
+        """Return a new hashlib object for a shasum -a style algorithm."""
+        checksum_type = str(checksum_type or DEFAULT_ALGORITHM)
+        name = SHASUM_ALGORITHMS.get(checksum_type, checksum_type)
+        try:
+            return hashlib.new(name)
+        except ValueError:
+            raise ProcessorError("Unsupported checksum_type: %s" % checksum_type)
+
+    def hash_file(self, path, hashers):
+        """Stream a file through one or more hash objects.
+
+        A single buffer is reused for every read so multi-GB files are hashed
+        in constant memory without per-chunk allocations.
+        """
+        method = self.env.get("checksum_read_method") or "readinto"
+        if method not in READ_METHODS:
+            raise ProcessorError("Unsupported checksum_read_method: %s" % method)
+        if method == "mmap" and self.hash_file_mmap(path, hashers):
+            return hashers
+        buf = bytearray(CHUNK_SIZE)
+        view = memoryview(buf)
+        try:
+            with open(path, "rb", buffering=0) as fileref:
+                while True:
+                    size = fileref.readinto(buf)
+                    if not size:
+                        break
+                    for hasher in hashers:
+                        hasher.update(view[:size])
+        except (IOError, OSError) as err:
+            raise ProcessorError("Can't read %s: %s" % (path, err))
+        return hashers
+
+    def hash_file_mmap(self, path, hashers):
+        """Hash a file from a read-only memory map.
+
+        Pages are fed to the digest directly from the page cache. Returns
+        False without touching the hashers if the file can't be mapped
+        (empty files, pipes, some network filesystems) so the caller can
+        fall back to buffered reads.
+        """
+        try:
+            fileref = open(path, "rb")
+        except (IOError, OSError) as err:
+            raise ProcessorError("Can't read %s: %s" % (path, err))
+        with fileref:
+            try:
+                mapped = mmap.mmap(fileref.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError) as err:
+                self.output(
+                    "Can't mmap %s, using buffered reads: %s" % (path, err),
+                    verbose_level=2,
+                )
+                return False
+        try:
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, len(mapped), MMAP_SLICE_SIZE):
+                    for hasher in hashers:
+                        hasher.update(view[offset : offset + MMAP_SLICE_SIZE])
+            finally:
+                view.release()
+        finally:
+            mapped.close()
+        return True
+
+    def load_cache(self, tree=None):
+        """Load the on-disk checksum cache, or disable caching.
+
+        A directory digest uses a cache file of its own for each tree, so
+        a later step hashing something else can't evict the tree's
+        entries, and the next run only rehashes the files that changed.
+        """
+        self.cache = None
+        self.cache_path = None
+        self.cache_dirty = False
+        self.cache_used = 0
+        self.cache_lock = threading.Lock()
+        if not self.env.get("checksum_cache"):
+            return
+        self.cache_path = self.env.get("checksum_cache_path")
+        if not self.cache_path:
+            if not self.env.get("RECIPE_CACHE_DIR"):
+                return
+            self.cache_path = os.path.join(self.env["RECIPE_CACHE_DIR"], CACHE_FILENAME)
+        if tree:
+            tree_id = hashlib.sha1(os.fsencode(os.path.abspath(tree))).hexdigest()
+            base, ext = os.path.splitext(self.cache_path)
+            self.cache_path = "%s.%s%s" % (base, tree_id[:16], ext)
+        self.cache = OrderedDict()
+        try:
+            with open(self.cache_path, "r") as fileref:
+                self.cache = json.load(fileref, object_pairs_hook=OrderedDict)
+        except (IOError, OSError):
+            pass
+        except ValueError:
+            self.output("Ignoring corrupt checksum cache at %s" % self.cache_path)
+
+    def save_cache(self):
+        """Evict least recently used entries and write the cache back."""
+        if self.cache is None or not self.cache_dirty:
+            return
+        max_size = int(self.env.get("checksum_cache_size") or 0)
+        # Entries used this run sit at the most recent end of the cache and
+        # are kept even past max_size, otherwise a large tree would evict
+        # its own digests.
+        while len(self.cache) > max(max_size, self.cache_used):
+            self.cache.popitem(last=False)
+        # Write to a temporary file first so an interrupted run can never
+        # leave a truncated cache behind.
+        tmp_path = "%s.%d.tmp" % (self.cache_path, os.getpid())
+        try:
+            with open(tmp_path, "w") as fileref:
+                json.dump(self.cache, fileref)
+            os.rename(tmp_path, self.cache_path)
+        except (IOError, OSError) as err:
+            self.output("Can't write checksum cache %s: %s" % (self.cache_path, err))
+
+    def cache_key(self, stat, hasher):
+        """Return the cache key for a file's stat result and algorithm."""
+        return "%d:%d:%d:%d:%s" % (
+            stat.st_dev,
+            stat.st_ino,
+            stat.st_size,
+            stat.st_mtime_ns,
+            hasher.name,
+        )
+
+    def checksum_file(self, path, checksum_types):
+        """Return hex digests of path for each of checksum_types.
+
+        Digests found in the cache are returned without reading the file;
+        any others are computed together in a single pass.
+        """
+        hashers = [self.new_hash(x) for x in checksum_types]
+        digests = [None] * len(hashers)
+        keys = [None] * len(hashers)
+        if self.cache is not None:
+            try:
+                stat = os.stat(path)
+            except OSError as err:
+                raise ProcessorError("Can't read %s: %s" % (path, err))
+            verify = self.env.get("checksum_verify")
+            with self.cache_lock:
+                for index, hasher in enumerate(hashers):
+                    keys[index] = self.cache_key(stat, hasher)
+                    if not verify and keys[index] in self.cache:
+                        digests[index] = self.cache.pop(keys[index])
+                        # Re-insert to mark the entry as most recently used.
+                        self.cache[keys[index]] = digests[index]
+                        self.cache_dirty = True
+                        self.cache_used += 1
+        missing = [x for x in range(len(hashers)) if digests[x] is None]
+        if missing:
+            # Every digest is fed from the same read so the file is only
+            # streamed off disk once regardless of how many types are needed.
+            self.hash_file(path, [hashers[x] for x in missing])
+            for index in missing:
+                digests[index] = hashers[index].hexdigest()
+            if self.cache is not None:
+                with self.cache_lock:
+                    for index in missing:
+                        cached = self.cache.pop(keys[index], digests[index])
+                        if cached != digests[index]:
+                            self.output("Cached checksum for %s was stale" % path)
+                        self.cache[keys[index]] = digests[index]
+                        self.cache_used += 1
+                    self.cache_dirty = True
+        return digests
+
+    def checksum_files(self, paths, checksum_type):
+        """Hash many files on a thread pool.
+
+        hashlib releases the GIL while digesting, so reads and hashing of
+        separate files overlap across cores. Returns an OrderedDict of path
+        to digest sorted by path, independent of completion order.
+        """
+        paths = sorted(set(paths))
+        workers = int(self.env.get("worker_count") or os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            digests = pool.map(
+                lambda path: self.checksum_file(path, [checksum_type])[0], paths
+            )
+            return OrderedDict(zip(paths, digests))
+
+    def write_manifest(self, manifest_path, checksums):
+        """Write a shasum-compatible manifest of path/digest pairs."""
+        try:
+            with open(manifest_path, "w") as fileref:
+                for path, digest in checksums.items():
+                    fileref.write("%s  %s\n" % (digest, path))
+        except (IOError, OSError) as err:
+            raise ProcessorError(
+                "Can't write manifest at %s: %s" % (manifest_path, err)
+            )
+        self.output("Wrote checksum manifest to %s" % manifest_path)
+
+    def walk_error(self, err):
+        """Raise a ProcessorError for an OSError met while walking a tree."""
+        raise ProcessorError("Can't read %s: %s" % (err.filename, err.strerror))
+
+    def tree_digest(self, root, checksum_type):
+        """Return a Merkle digest of the directory tree at root.
+
+        Regular files are hashed in parallel through checksum_files, so
+        unchanged files come straight from the cache. Each directory then
+        hashes one "kind mode digest name" line per entry, sorted by name,
+        and its digest feeds into its parent's, so a chmod changes the
+        digest too. Symlinks are hashed by target and not followed. An
+        unreadable directory fails rather than being left out.
+        """
+        if not os.path.isdir(root):
+            raise ProcessorError("Can't find directory %s" % root)
+        root = os.path.normpath(root)
+        tree = {}
+        files = []
+        for dirpath, dirnames, filenames in os.walk(root, onerror=self.walk_error):
+            entries = tree[dirpath] = []
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    mode = os.lstat(path).st_mode
+                except OSError as err:
+                    self.walk_error(err)
+                if stat.S_ISLNK(mode):
+                    entries.append((name, "link", 0, path))
+                elif stat.S_ISDIR(mode):
+                    entries.append((name, "tree", stat.S_IMODE(mode), path))
+                elif stat.S_ISREG(mode):
+                    entries.append((name, "blob", stat.S_IMODE(mode), path))
+                    files.append(path)
+        digests = self.checksum_files(files, checksum_type)
+        # A child's path is always longer than its parent's, so walking the
+        # directories longest path first finishes children before parents.
+        for dirpath in sorted(tree, key=len, reverse=True):
+            hasher = self.new_hash(checksum_type)
+            for name, kind, mode, path in sorted(tree[dirpath]):
+                if kind == "link":
+                    link = self.new_hash(checksum_type)
+                    link.update(os.fsencode(os.readlink(path)))
+                    digest = link.hexdigest()
+                else:
+                    digest = digests[path]
+                hasher.update(
+                    b"%s %o %s %s\n"
+                    % (kind.encode(), mode, digest.encode(), os.fsencode(name))
+                )
+            digests[dirpath] = hasher.hexdigest()
+        self.output(
+            "Hashed %d files in %d directories" % (len(files), len(tree)),
+            verbose_level=2,
+        )
+        return digests[root]
+
+    def batch_main(self):
+        """Checksum every file in source_files."""
+        source_files = self.env["source_files"]
+        if isinstance(source_files, list):
+            paths = source_files
+        else:
+            paths = [x for x in glob(source_files) if os.path.isfile(x)]
+            if not paths:
+                raise ProcessorError("No files found matching %s" % source_files)
+        checksums = self.checksum_files(paths, self.env.get("checksum_type"))
+        for path, digest in checksums.items():
+            self.output("%s  %s" % (digest, path), verbose_level=2)
+        self.output("Calculated checksums for %d files" % len(checksums))
+        self.env["checksums"] = checksums
+        if self.env.get("checksum_manifest_path"):
+            self.write_manifest(self.env["checksum_manifest_path"], checksums)
+
     def main(self):
-        sha_args = self.env.get("checksum_type", None)
-        cmd = ["/usr/bin/shasum"]
-        if sha_args:
-            cmd.append("-a")
-            cmd.append(sha_args)
-        cmd.append(self.env["source_file"])
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        (shaout, shaerr) = proc.communicate()
-        if shaerr:
-            raise ProcessorError(shaerr)
-        self.output(shaout)
-        self.env["checksum"] = shaout.split()[0].decode("utf-8")
+        source_file = self.env.get("source_file")
+        checksum_types = self.env.get("checksum_types")
+        if checksum_types and not isinstance(checksum_types, list):
+            raise ProcessorError("checksum_types must be a list!")
+        self.load_cache(self.env.get("source_directory"))
+        if self.env.get("source_directory"):
+            source_directory = self.env["source_directory"]
+            checksum_type = self.env.get("checksum_type")
+            self.env["checksum"] = self.tree_digest(source_directory, checksum_type)
+            self.output("%s  %s" % (self.env["checksum"], source_directory))
+        elif self.env.get("source_files"):
+            self.batch_main()
+        elif not source_file:
+            raise ProcessorError(
+                "One of source_file, source_files or source_directory is required!"
+            )
+        elif not checksum_types:
+            checksum_type = self.env.get("checksum_type")
+            checksum = self.checksum_file(source_file, [checksum_type])[0]
+            self.env["checksum"] = checksum
+            self.output("%s  %s" % (checksum, source_file))
+        else:
+            checksum_types = [str(x) for x in checksum_types]
+            digests = self.checksum_file(source_file, checksum_types)
+            for checksum_type, digest in zip(checksum_types, digests):
+                self.env["checksum_%s" % checksum_type] = digest
+                self.output("%s (%s)  %s" % (digest, checksum_type, source_file))
+            self.env["checksum"] = digests[0]
+        self.save_cache()
+        # clean the mode variables up afterwards to not poison future runs
+        for key in (
+            "checksum_types",
+            "source_directory",
+            "source_files",
+            "checksum_manifest_path",
+        ):
+            self.env[key] = ""
 
 
 if __name__ == "__main__":
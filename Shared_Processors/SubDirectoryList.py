@@ -10,12 +10,28 @@
 
 from __future__ import absolute_import
 
+import bz2
+import gzip
+import io
+import json
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
 from autopkglib import Processor, ProcessorError
 
+# AutoPkg loads processors by file path, so make the shared helper next to
+# this file importable.
+if os.path.dirname(__file__) not in sys.path:
+    sys.path.insert(0, os.path.dirname(__file__))
+from PathFilter import PathFilter  # noqa: E402
+
 __all__ = ["SubDirectoryList"]
 
+# We need to remove the SIP folders so Chef doesn't try to create them
+SIP_DIRS = frozenset(["usr", "usr/local", "private", "private/etc", "Library"])
+MANIFEST_OPENERS = {"": io.open, "gzip": gzip.open, "bz2": bz2.open}
+
 
 class SubDirectoryList(Processor):
     """Finds a filename for use in other Processors.
@@ -25,8 +41,35 @@ class SubDirectoryList(Processor):
 
     input_variables = {
         "root_path": {
-            "description": "Path to start looking for files.",
-            "required": True,
+            "description": (
+                "Path to start looking for files. Required unless root_paths is set."
+            ),
+            "required": False,
+        },
+        "root_paths": {
+            "description": (
+                "List of paths to walk in parallel instead of root_path. "
+                "Results are relative to the deepest directory containing "
+                "all of them, which is stored in relative_root, and are "
+                "sorted by path."
+            ),
+            "required": False,
+        },
+        "parallel_walk": {
+            "description": (
+                "Split root_path at its top level and walk each top-level "
+                "directory on a thread pool. Results are sorted by path. "
+                "Defaults to False."
+            ),
+            "default": False,
+            "required": False,
+        },
+        "worker_count": {
+            "description": (
+                "Number of threads used by root_paths and parallel_walk. "
+                "Defaults to the Python thread pool default."
+            ),
+            "required": False,
         },
         "suffix_string": {
             "description": (
@@ -35,6 +78,61 @@ class SubDirectoryList(Processor):
             "default": ",",
             "required": False,
         },
+        "include_patterns": {
+            "description": (
+                "List of gitignore-style patterns. If set, only files "
+                "matching one of them are listed. A pattern without a slash "
+                "matches a name at any depth, one with a slash is anchored "
+                "at the root, and ** matches across directories."
+            ),
+            "required": False,
+        },
+        "exclude_patterns": {
+            "description": (
+                "List of gitignore-style patterns of files and directories "
+                "to leave out. Excluded directories are not descended into. "
+                "A trailing slash only matches directories, e.g. "
+                "Contents/Developer/Platforms/*Simulator*/"
+            ),
+            "required": False,
+        },
+        "manifest_path": {
+            "description": (
+                "If set, stream every entry found into this file, one path "
+                "per line with directories ending in '/', instead of "
+                "storing the lists in found_filenames and found_directories."
+            ),
+            "required": False,
+        },
+        "manifest_compression": {
+            "description": (
+                "Compress the manifest file. Either 'gzip' or 'bz2'. "
+                "Defaults to no compression."
+            ),
+            "default": "",
+            "required": False,
+        },
+        "snapshot_path": {
+            "description": (
+                "Enables incremental mode. Path to a snapshot of the previous "
+                "walk (path, type, size and mtime of every entry). The walk "
+                "is compared against it to set added_paths, removed_paths "
+                "and modified_paths, and the snapshot is then updated. "
+                "Directories whose mtime and link count are unchanged are "
+                "not listed again."
+            ),
+            "required": False,
+        },
+        "snapshot_check_files": {
+            "description": (
+                "In incremental mode, stat the files of unchanged directories "
+                "to catch files modified in place. If False, those files are "
+                "assumed unchanged, which makes re-runs over unchanged trees "
+                "much faster. Defaults to True."
+            ),
+            "default": True,
+            "required": False,
+        },
     }
     output_variables = {
         "found_filenames": {
@@ -51,39 +149,406 @@ class SubDirectoryList(Processor):
                 "suffix_string."
             )
         },
-        "relative_root": {"description": ("Relative root path")},
+        "found_filenames_list": {
+            "description": (
+                "List of all files found relative to root_path. Unlike "
+                "found_filenames, safe for names containing suffix_string."
+            )
+        },
+        "found_directories_list": {
+            "description": (
+                "List of all directories found relative to root_path. "
+                "Unlike found_directories, safe for names containing "
+                "suffix_string."
+            )
+        },
+        "found_file_count": {"description": ("Number of files found.")},
+        "found_directory_count": {"description": ("Number of directories found.")},
+        "added_paths": {"description": ("Incremental mode. Sorted list of new paths.")},
+        "removed_paths": {
+            "description": ("Incremental mode. Sorted list of removed paths.")
+        },
+        "modified_paths": {
+            "description": (
+                "Incremental mode. Sorted list of paths whose type changed, "
+                "or files whose size or mtime changed."
+            )
+        },
+        "relative_root": {
+            "description": (
+                "Relative root path. Set to the common parent of root_paths "
+                "when that is used."
+            )
+        },
     }
 
     description = __doc__
 
+    def walk(self, root, relative_to=None):
+        """Yield (relative_path, is_dir) for everything below root.
+
+        Entries come out in the same top-down order as os.walk, but each
+        directory is read with a single os.scandir call and relative paths
+        are sliced off the full path instead of going through relpath.
+        Symlinks to directories are not followed or reported. If
+        relative_to is a parent of root, paths are relative to it and root
+        itself is included.
+        """
+        path_filter = self.path_filter
+        prefix_len = len(os.path.join(relative_to or root, ""))
+        stack = [root]
+        while stack:
+            dirpath = stack.pop()
+            # The root itself slices down to an empty string.
+            if dirpath[prefix_len:]:
+                yield dirpath[prefix_len:], True
+            subdirs = []
+            try:
+                with os.scandir(dirpath) as entries:
+                    for entry in entries:
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            is_dir = False
+                        if is_dir:
+                            # Excluded directories are pruned here, before
+                            # anything below them is read.
+                            if not entry.is_symlink() and (
+                                path_filter is None
+                                or path_filter.keep_dir(entry.path[prefix_len:])
+                            ):
+                                subdirs.append(entry.path)
+                        elif ".DS_Store" not in entry.name and (
+                            path_filter is None
+                            or path_filter.keep_file(entry.path[prefix_len:])
+                        ):
+                            yield entry.path[prefix_len:], False
+            except OSError as err:
+                self.output("Can't list %s: %s" % (dirpath, err))
+            # Reversed so the first subdirectory is popped (visited) first.
+            stack.extend(reversed(subdirs))
+
+    def walk_parallel(self, roots, base):
+        """Walk several subtrees of base on a thread pool.
+
+        os.scandir releases the GIL while it waits on the filesystem, so
+        separate subtrees are listed concurrently. A single root is split
+        into its top-level directories. Directories between base and each
+        root are included. Returns the merged entries sorted by path.
+        """
+        base = os.path.join(base, "")
+        entries = []
+        subtrees = []
+        for root in roots:
+            root = os.path.normpath(root)
+            if os.path.join(root, "") == base:
+                # Split the base itself at its top level.
+                for relpath, is_dir in self.walk_top_level(root):
+                    if is_dir:
+                        subtrees.append(os.path.join(root, relpath))
+                    else:
+                        entries.append((relpath, False))
+                continue
+            subtrees.append(root)
+            parent = os.path.dirname(root)
+            while len(parent) > len(base):
+                entries.append((parent[len(base) :], True))
+                parent = os.path.dirname(parent)
+        workers = self.env.get("worker_count")
+        with ThreadPoolExecutor(max_workers=int(workers) if workers else None) as pool:
+            for subtree in pool.map(lambda x: list(self.walk(x, base)), subtrees):
+                entries.extend(subtree)
+        entries.sort()
+        # Overlapping roots and shared parents produce adjacent duplicates.
+        return [x for i, x in enumerate(entries) if not i or x != entries[i - 1]]
+
+    def walk_top_level(self, root):
+        """Yield (name, is_dir) for the immediate entries of root."""
+        path_filter = self.path_filter
+        try:
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        if not entry.is_symlink() and (
+                            path_filter is None or path_filter.keep_dir(entry.name)
+                        ):
+                            yield entry.name, True
+                    elif ".DS_Store" not in entry.name and (
+                        path_filter is None or path_filter.keep_file(entry.name)
+                    ):
+                        yield entry.name, False
+        except OSError as err:
+            raise ProcessorError("Can't list %s: %s" % (root, err))
+
+    def walk_incremental(self, root, previous, snapshot):
+        """Like walk, but records every entry into snapshot.
+
+        Snapshot entries map a relative path to a "size:mtime_ns" string
+        for files, and a [nlink, mtime_ns, children] list for directories.
+        Keeping file entries as plain strings makes the snapshot much
+        cheaper to load and compare. A directory whose mtime and link count
+        match the previous snapshot has not gained or lost entries, so its
+        old child list is reused instead of being read again; its
+        subdirectories are still checked. Sets self.snapshot_changed if
+        anything may differ from the previous snapshot.
+        """
+        path_filter = self.path_filter
+        self.snapshot_changed = False
+        check_files = self.env.get("snapshot_check_files")
+        prefix_len = len(os.path.join(root, ""))
+        stack = [root]
+        while stack:
+            dirpath = stack.pop()
+            relpath = dirpath[prefix_len:]
+            try:
+                stat = os.stat(dirpath)
+            except OSError as err:
+                self.output("Can't stat %s: %s" % (dirpath, err))
+                continue
+            if relpath:
+                yield relpath, True
+            relprefix = os.path.join(relpath, "") if relpath else ""
+            old = previous.get(relpath)
+            children = []
+            subdirs = []
+            if (
+                isinstance(old, list)
+                and old[0] == stat.st_nlink
+                and old[1] == stat.st_mtime_ns
+            ):
+                children = old[2]
+                dirprefix = os.path.join(dirpath, "")
+                for name in children:
+                    child = relprefix + name
+                    old_child = previous[child]
+                    if isinstance(old_child, list):
+                        subdirs.append(dirprefix + name)
+                        continue
+                    if check_files:
+                        try:
+                            child_stat = os.lstat(dirprefix + name)
+                        except OSError:
+                            self.snapshot_changed = True
+                            continue
+                        snapshot[child] = "%d:%d" % (
+                            child_stat.st_size,
+                            child_stat.st_mtime_ns,
+                        )
+                        if snapshot[child] != old_child:
+                            self.snapshot_changed = True
+                    else:
+                        snapshot[child] = old_child
+                    yield child, False
+            else:
+                self.snapshot_changed = True
+                try:
+                    with os.scandir(dirpath) as entries:
+                        for entry in entries:
+                            try:
+                                is_dir = entry.is_dir()
+                            except OSError:
+                                is_dir = False
+                            child = entry.path[prefix_len:]
+                            if is_dir:
+                                if not entry.is_symlink() and (
+                                    path_filter is None or path_filter.keep_dir(child)
+                                ):
+                                    children.append(entry.name)
+                                    subdirs.append(entry.path)
+                            elif ".DS_Store" not in entry.name and (
+                                path_filter is None or path_filter.keep_file(child)
+                            ):
+                                try:
+                                    child_stat = entry.stat(follow_symlinks=False)
+                                except OSError:
+                                    continue
+                                children.append(entry.name)
+                                snapshot[child] = "%d:%d" % (
+                                    child_stat.st_size,
+                                    child_stat.st_mtime_ns,
+                                )
+                                yield child, False
+                except OSError as err:
+                    self.output("Can't list %s: %s" % (dirpath, err))
+            snapshot[relpath] = [stat.st_nlink, stat.st_mtime_ns, children]
+            stack.extend(reversed(subdirs))
+
+    def load_snapshot(self, snapshot_path):
+        """Return the previous snapshot, or an empty one."""
+        try:
+            with open(snapshot_path, "r") as fileref:
+                return json.load(fileref)
+        except (IOError, OSError):
+            return {}
+        except ValueError:
+            self.output("Ignoring corrupt snapshot at %s" % snapshot_path)
+            return {}
+
+    def save_snapshot(self, snapshot_path, snapshot):
+        """Atomically replace the snapshot file."""
+        tmp_path = "%s.%d.tmp" % (snapshot_path, os.getpid())
+        try:
+            with open(tmp_path, "w") as fileref:
+                # dumps() uses the C encoder, dump() would iterate in Python.
+                fileref.write(json.dumps(snapshot, separators=(",", ":")))
+            os.rename(tmp_path, snapshot_path)
+        except (IOError, OSError) as err:
+            raise ProcessorError("Can't write snapshot %s: %s" % (snapshot_path, err))
+
+    def compare_snapshots(self, previous, snapshot):
+        """Set added_paths, removed_paths and modified_paths.
+
+        Returns True if anything changed.
+        """
+        if not self.snapshot_changed:
+            # Every directory listing was reused and no file changed.
+            self.env["added_paths"] = []
+            self.env["removed_paths"] = []
+            self.env["modified_paths"] = []
+            self.output("No changes since the last run")
+            return False
+        # The root is recorded under "" and is never reported.
+        added = sorted(snapshot.keys() - previous.keys() - {""})
+        removed = sorted(previous.keys() - snapshot.keys() - {""})
+        modified = []
+        for path in sorted(snapshot.keys() & previous.keys() - {""}):
+            old = previous[path]
+            new = snapshot[path]
+            # Files compare on size and mtime, directories only on type.
+            if old != new and not (isinstance(old, list) and isinstance(new, list)):
+                modified.append(path)
+        self.env["added_paths"] = added
+        self.env["removed_paths"] = removed
+        self.env["modified_paths"] = modified
+        self.output(
+            "%d added, %d removed, %d modified since the last run"
+            % (len(added), len(removed), len(modified))
+        )
+        return bool(added or removed or modified)
+
+    def write_manifest(self, entries, manifest_path):
+        """Stream (relative_path, is_dir) entries into manifest_path.
+
+        Nothing but the counts is kept in memory, so this works for trees
+        of any size.
+        """
+        compression = self.env.get("manifest_compression") or ""
+        if compression not in MANIFEST_OPENERS:
+            raise ProcessorError("Unsupported manifest_compression: %s" % compression)
+        file_count = 0
+        dir_count = 0
+        try:
+            with MANIFEST_OPENERS[compression](
+                manifest_path, "wt", encoding="utf-8", errors="surrogateescape"
+            ) as manifest:
+                for relpath, is_dir in entries:
+                    if not is_dir:
+                        manifest.write(relpath + "\n")
+                        file_count += 1
+                    elif relpath not in SIP_DIRS:
+                        manifest.write(relpath + "/\n")
+                        dir_count += 1
+        except (IOError, OSError) as err:
+            raise ProcessorError(
+                "Can't write manifest at %s: %s" % (manifest_path, err)
+            )
+        self.output("Wrote manifest to %s" % manifest_path)
+        return file_count, dir_count
+
     def main(self):
-        sip_dirs = ["usr", "usr/local", "private", "private/etc", "Library"]
+        dir_list = list()
+        file_list = list()
+        root_paths = self.env.get("root_paths")
+        if root_paths:
+            if not isinstance(root_paths, list):
+                raise ProcessorError("root_paths must be a list!")
+            root_paths = [os.path.abspath(x) for x in root_paths]
+            root_path = os.path.commonpath(root_paths)
+            self.env["relative_root"] = root_path
+        else:
+            root_path = self.env.get("root_path")
+            root_paths = [root_path] if self.env.get("parallel_walk") else None
+        if not root_path:
+            raise ProcessorError("Either root_path or root_paths is required!")
+        for path in root_paths or [root_path]:
+            if not os.path.isdir(path):
+                raise ProcessorError("Can't find root path %s!" % path)
+        patterns = [
+            self.env.get("include_patterns") or [],
+            self.env.get("exclude_patterns") or [],
+        ]
+        self.path_filter = None
+        if patterns[0] or patterns[1]:
+            self.path_filter = PathFilter(include=patterns[0], exclude=patterns[1])
+        snapshot_path = self.env.get("snapshot_path")
+        if snapshot_path and root_paths:
+            raise ProcessorError(
+                "snapshot_path can't be combined with root_paths or parallel_walk"
+            )
+        if snapshot_path:
+            previous = self.load_snapshot(snapshot_path)
+            # The patterns are stored with the root entry. Listings taken
+            # with different patterns can't be reused.
+            reusable = previous
+            if previous.get("", [])[3:] != [patterns]:
+                reusable = {}
+            snapshot = {}
+            entries = self.walk_incremental(root_path, reusable, snapshot)
+        elif root_paths:
+            entries = self.walk_parallel(root_paths, root_path)
+        else:
+            entries = self.walk(root_path)
+        if self.env.get("manifest_path"):
+            file_count, dir_count = self.write_manifest(
+                entries, self.env["manifest_path"]
+            )
+            self.env["found_file_count"] = file_count
+            self.env["found_directory_count"] = dir_count
+            # Don't leave an earlier step's lists behind for later steps.
+            for key in ("found_directories", "found_filenames"):
+                self.env[key] = ""
+                self.env["%s_list" % key] = []
+            self.output("Found %d files and %d directories" % (file_count, dir_count))
+        else:
+            for relpath, is_dir in entries:
+                if not is_dir:
+                    self.output("Relative path: %s" % relpath, verbose_level=3)
+                    file_list.append(relpath)
+                elif relpath not in SIP_DIRS:
+                    dir_list.append(relpath)
+            self.set_found_lists(file_list, dir_list)
+        if snapshot_path:
+            if "" in snapshot:
+                snapshot[""].append(patterns)
+            changed = self.compare_snapshots(previous, snapshot)
+            # Directories that were re-listed without any entry changing are
+            # simply listed again next time, so an unchanged tree needs no
+            # rewrite of the snapshot.
+            if changed or not previous:
+                self.save_snapshot(snapshot_path, snapshot)
+        # clean the variables up afterwards to not poison future runs
+        self.env["root_paths"] = ""
+        self.env["parallel_walk"] = False
+        self.env["manifest_path"] = ""
+        self.env["manifest_compression"] = ""
+        self.env["snapshot_path"] = ""
+
+    def set_found_lists(self, file_list, dir_list):
+        """Store the found files and directories in the environment."""
         format_string = "%s" % self.env["suffix_string"]
         # search_string = '  \'{0}\''
         search_string = "{0}"
-        dir_list = list()
-        file_list = list()
-        if not os.path.isdir(self.env["root_path"]):
-            raise ProcessorError("Can't find root path!")
-        for dirName, subdirList, fileList in os.walk(self.env["root_path"]):
-            relative_path = os.path.relpath(dirName, self.env["root_path"])
-            # We need to remove the SIP folders so Chef doesn't try to create them
-            if not relative_path == "." and not (relative_path in sip_dirs):
-                dir_list.append(relative_path)
-            # search_string.format(format_string.join(dirName)).strip()
-            for fname in fileList:
-                if ".DS_Store" in fname:
-                    continue
-                # print('\t%s' % fname)
-                relpath = os.path.relpath(
-                    os.path.join(fname, dirName), self.env["root_path"]
-                )
-                self.output("Relative path: %s" % relpath)
-                if relpath == ".":
-                    # we want to avoid prepending './' to files at root dir
-                    relpath = ""
-                # print "Real relative path: %s" % relpath
-                file_list.append(os.path.join(relpath, fname))
+        self.output(
+            "Found %d files and %d directories" % (len(file_list), len(dir_list))
+        )
+        self.env["found_file_count"] = len(file_list)
+        self.env["found_directory_count"] = len(dir_list)
+        self.env["found_directories_list"] = dir_list
+        self.env["found_filenames_list"] = file_list
         self.env["found_directories"] = search_string.format(
             format_string.join(dir_list)
         ).strip()